@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the sanitization of BlueVia responses and notifications.
+
+It compares the schema-specialized sanitizers (and the compiled timestamp parser) with the generic
+strptime-based sanitize() implementation they replace.
+
+"""
+
+from datetime import datetime
+
+from harness import measure, report
+
+from bluevia.utils import sanitize, sanitize_incoming_message, sanitize_delivery_status, parse_timestamp
+
+
+def legacy_sanitize(output):
+    # sanitize() as it was before parse_timestamp() was introduced
+    if isinstance(output, dict):
+        for (k, v) in output.items():
+            if k in ('from', 'to', 'address'):
+                obfuscated = v.startswith('alias:')
+                output[k] = v[6:] if obfuscated else v[5:]
+                if k == 'from':
+                    output[u'obfuscated'] = obfuscated
+            elif k == 'timestamp':
+                output[k] = datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%f+0000')
+        return output
+    elif isinstance(output, list):
+        return [legacy_sanitize(item) for item in output]
+    else:
+        return output
+
+
+SMS = {u'id': u'97286813874922402286',
+       u'from': u'tel:+34600000000',
+       u'to': u'tel:+34217040',
+       u'message': u'keyword Hello world!',
+       u'timestamp': u'2012-12-27T16:17:42.418+0000'}
+
+DELIVERY_STATUS = {u'id': u'97286813874922402286',
+                   u'address': u'alias:2a4e7e6f1f4b0c1d',
+                   u'status': u'delivered'}
+
+SMS_BATCH = [dict(SMS, id=unicode(i)) for i in range(1000)]
+
+
+def main():
+    timestamp = SMS['timestamp']
+    assert parse_timestamp(timestamp) == datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f+0000')
+    assert sanitize_incoming_message(dict(SMS)) == legacy_sanitize(dict(SMS))
+    assert sanitize_delivery_status(dict(DELIVERY_STATUS)) == legacy_sanitize(dict(DELIVERY_STATUS))
+
+    report('Timestamp parsing', [
+        ('datetime.strptime', measure(lambda: datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f+0000'))),
+        ('parse_timestamp', measure(lambda: parse_timestamp(timestamp))),
+    ])
+
+    report('Incoming SMS', [
+        ('legacy sanitize', measure(lambda: legacy_sanitize(dict(SMS)))),
+        ('sanitize', measure(lambda: sanitize(dict(SMS)))),
+        ('sanitize_incoming_message', measure(lambda: sanitize_incoming_message(dict(SMS)))),
+    ])
+
+    report('Delivery status', [
+        ('legacy sanitize', measure(lambda: legacy_sanitize(dict(DELIVERY_STATUS)))),
+        ('sanitize', measure(lambda: sanitize(dict(DELIVERY_STATUS)))),
+        ('sanitize_delivery_status', measure(lambda: sanitize_delivery_status(dict(DELIVERY_STATUS)))),
+    ])
+
+    report('Batch of 1000 incoming SMS', [
+        ('legacy sanitize', measure(lambda: legacy_sanitize([dict(sms) for sms in SMS_BATCH]))),
+        ('sanitize_incoming_message', measure(lambda: [sanitize_incoming_message(dict(sms))
+                                                       for sms in SMS_BATCH])),
+    ])
+
+
+if __name__ == '__main__':
+    main()
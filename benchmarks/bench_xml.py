@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the parsing of XML notifications (incoming SMS and MMS metadata).
+
+It compares the single-pass xml_to_dict() implementation, which compiles its pattern once per set of keys,
+with the previous one, which built and ran a regular expression per key on every call.
+
+"""
+
+import re
+
+from harness import measure, report
+
+from bluevia.utils import xml_to_dict
+
+
+def legacy_xml_to_dict(xml, keys):
+    # xml_to_dict() as it was before being rewritten as a single pass parser
+    try:
+        if not isinstance(xml, unicode):
+            xml = unicode(xml, 'utf-8')
+
+        dict_ = {}
+        for key in keys:
+            if not isinstance(key, unicode):
+                key = unicode(key, 'utf-8')
+            dict_[key] = re.search('<.*' + key + '>(.*)</.*' + key + '>', xml).group(1)
+
+        return dict_
+    except AttributeError:
+        raise KeyError('XML does not contain the key: ' + key)
+
+
+SMS_KEYS = ('id', 'from', 'to', 'message', 'timestamp')
+MMS_KEYS = ('id', 'from', 'to', 'subject', 'timestamp')
+
+SMS_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<ns2:inboundSMSMessage xmlns:ns2="http://api.bluevia.com/schema/sms/v2">
+  <ns2:id>97286813874922402286</ns2:id>
+  <ns2:from>tel:+34600000000</ns2:from>
+  <ns2:to>tel:+34217040</ns2:to>
+  <ns2:message>keyword Hello world!</ns2:message>
+  <ns2:timestamp>2012-12-27T16:17:42.418+0000</ns2:timestamp>
+</ns2:inboundSMSMessage>
+'''
+
+MMS_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<ns2:inboundMMSMessage xmlns:ns2="http://api.bluevia.com/schema/mms/v2">
+  <ns2:id>2515357468066729</ns2:id>
+  <ns2:from>alias:2a4e7e6f1f4b0c1d</ns2:from>
+  <ns2:to>tel:+34217040</ns2:to>
+  <ns2:subject>keyword Photo</ns2:subject>
+  <ns2:timestamp>2012-12-28T10:39:05.242+0000</ns2:timestamp>
+</ns2:inboundMMSMessage>
+'''
+
+# A notification in a single line with lots of extension elements before the fields and a long message
+OVERSIZED_SMS_XML = ('<?xml version="1.0" encoding="UTF-8"?>'
+                     '<ns2:inboundSMSMessage xmlns:ns2="http://api.bluevia.com/schema/sms/v2">' +
+                     ''.join('<ns2:extension{0}>value {0}</ns2:extension{0}>'.format(i) for i in range(500)) +
+                     '<ns2:id>97286813874922402286</ns2:id>'
+                     '<ns2:from>tel:+34600000000</ns2:from>'
+                     '<ns2:to>tel:+34217040</ns2:to>'
+                     '<ns2:message>keyword ' + 'Hello world! ' * 1000 + '</ns2:message>'
+                     '<ns2:timestamp>2012-12-27T16:17:42.418+0000</ns2:timestamp>'
+                     '</ns2:inboundSMSMessage>')
+
+
+def main():
+    assert xml_to_dict(SMS_XML, SMS_KEYS) == legacy_xml_to_dict(SMS_XML, SMS_KEYS)
+    assert xml_to_dict(MMS_XML, MMS_KEYS) == legacy_xml_to_dict(MMS_XML, MMS_KEYS)
+
+    report('Incoming SMS notification ({0} bytes)'.format(len(SMS_XML)), [
+        ('legacy xml_to_dict', measure(lambda: legacy_xml_to_dict(SMS_XML, SMS_KEYS))),
+        ('xml_to_dict', measure(lambda: xml_to_dict(SMS_XML, SMS_KEYS))),
+    ])
+
+    report('Incoming MMS metadata ({0} bytes)'.format(len(MMS_XML)), [
+        ('legacy xml_to_dict', measure(lambda: legacy_xml_to_dict(MMS_XML, MMS_KEYS))),
+        ('xml_to_dict', measure(lambda: xml_to_dict(MMS_XML, MMS_KEYS))),
+    ])
+
+    report('Oversized SMS notification ({0} bytes)'.format(len(OVERSIZED_SMS_XML)), [
+        ('legacy xml_to_dict', measure(lambda: legacy_xml_to_dict(OVERSIZED_SMS_XML, SMS_KEYS))),
+        ('xml_to_dict', measure(lambda: xml_to_dict(OVERSIZED_SMS_XML, SMS_KEYS))),
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""
+benchmarks.harness
+~~~~~~~~~~~~~~~~~~
+
+Helpers shared by pyBlueVia benchmarks.
+
+"""
+
+import os
+import sys
+import timeit
+
+# Benchmarks are run against the source tree they live in
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+
+def measure(func, min_time=0.2, repeat=3):
+
+    """Return the best time (in seconds) taken by a call to func.
+
+    func is called in loops long enough to last at least min_time seconds, and the best of repeat loops is taken.
+
+    """
+
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    return min([elapsed] + timer.repeat(repeat - 1, number)) / number
+
+
+def report(title, results):
+
+    """Print benchmark results, given as a list of (name, seconds per call) tuples.
+
+    The first result is taken as the reference the rest are compared to.
+
+    """
+
+    print title
+    reference = results[0][1]
+    for name, seconds in results:
+        print '  {0:<40} {1:>12.2f} us  {2:>6.2f}x'.format(name, seconds * 1e6, reference / seconds)
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark suite of pyBlueVia hot paths, compared against locally saved baselines.
+
+Each case is run in its own process, which reports the time per call and the peak memory (the growth
+of the resident set size while making a call). Baselines depend on the machine, so none are shipped: they
+are saved (with --save-baseline) on the machine the suite is run on, in baselines.local.json (ignored by
+git), e.g. before making a change. Later runs are compared with them, and fail if any case is slower than
+its baseline by more than the tolerance, or needs more memory by more than the memory tolerance and the
+memory noise floor (small allocations are rounded to memory pages, and the allocator's arenas vary from run
+to run). Cases over the tolerance are run again (see --attempts) before being reported as regressions, so a
+noisy machine does not make the run fail. Without baselines, results are just reported.
+
+Cases use the JSON library pyBlueVia picks (see bluevia.jsoncodec), unless another one is set with --json,
+so the gain of a faster library can be measured against baselines saved with the standard library.
+
+Usage::
+
+    $ python benchmarks/suite.py --save-baseline  # Save the current results as baselines
+    $ python benchmarks/suite.py                  # Compare with the saved baselines
+    $ python benchmarks/suite.py parse_mms_10mb   # Run (and compare) some cases
+    $ python benchmarks/suite.py --json json      # Run the cases with the standard library json module
+
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+from harness import measure
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from bluevia import Api, set_json_codec
+from bluevia.notifications import parse_notification
+from bluevia.utils import MmsTemplate, OAuth2, SNIFF_SIZE, build_mms_body, parse_mms_body, sanitize
+from bluevia.utils import sanitize_incoming_message, sniff_content_type, xml_to_dict
+
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.local.json')
+
+KB = 1024
+MB = 1024 * KB
+
+SMS_METADATA = {u'id': u'97286813874922402286',
+                u'from': u'tel:+34600000000',
+                u'to': u'tel:+34217040',
+                u'timestamp': u'2012-12-27T16:17:42.418+0000'}
+
+
+JPEG_HEADER = ('\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x01\x00H\x00H\x00\x00' + '\x00' * SNIFF_SIZE)[:SNIFF_SIZE]
+MP4_HEADER = ('\x00\x00\x00\x20ftypisom\x00\x00\x02\x00isomiso2avc1mp41' + '\x00' * SNIFF_SIZE)[:SNIFF_SIZE]
+
+
+def _sms(size):
+    # An incoming SMS whose JSON representation takes about size bytes
+    message = u'keyword ' + u'x' * (size - len(json.dumps(SMS_METADATA)) - 20)
+    return dict(SMS_METADATA, message=message)
+
+
+def _sms_xml(size):
+    sms = _sms(size)
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<ns2:inboundSMSMessage xmlns:ns2="http://api.bluevia.com/schema/sms/v2">\n' +
+            ''.join('  <ns2:{0}>{1}</ns2:{0}>\n'.format(key, sms[key]) for key in sorted(sms)) +
+            '</ns2:inboundSMSMessage>\n')
+
+
+def _binary(size):
+    # Pseudorandom (as compressed images are) but the same in every run, so results are comparable
+    return ''.join(hashlib.sha256(str(i)).digest() for i in xrange(size // 32 + 1))[:size]
+
+
+def _mms_attachment_file(size):
+    # Attachments are sent from files, as apps usually do
+    attachment = tempfile.TemporaryFile()
+    attachment.write(_binary(size))
+    attachment.seek(0)
+    return attachment
+
+
+def _mms_body(size):
+    metadata = dict(SMS_METADATA, subject=u'keyword Photo')
+    encoder = build_mms_body(metadata, [u'Look at this picture', ('image/jpeg', _mms_attachment_file(size))])
+    return encoder.content_type, encoder.read()
+
+
+class _CannedAdapter(BaseAdapter):
+
+    """Transport adapter which answers every request with the same response, without any network I/O,
+    so the overhead of pyBlueVia (and requests) can be measured alone.
+
+    """
+
+    def __init__(self, status_code, content):
+        super(_CannedAdapter, self).__init__()
+        self.status_code = status_code
+        self.content = content
+
+    def send(self, request, **kwargs):
+        resp = requests.Response()
+        resp.status_code = self.status_code
+        resp.reason = 'OK'
+        resp.headers = CaseInsensitiveDict({'content-type': 'application/json;charset=UTF-8',
+                                            'content-length': str(len(self.content))})
+        resp._content = self.content
+        resp.encoding = 'utf-8'
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+def _canned_api(status_code, content):
+    Api.configure_pool(pool_group='benchmark')
+    Api._pool_session('benchmark').mount('https://', _CannedAdapter(status_code, content))
+    return Api('CLIENT_ID', 'CLIENT_SECRET', 'ACCESS_TOKEN', pool_group='benchmark')
+
+
+# Cases: each case_<name> function prepares a case and returns the function to be measured
+
+def case_import_bluevia():
+    # Cold start of a process importing pyBlueVia (from the source tree), as short-lived jobs do
+    command = [sys.executable, '-c', 'import bluevia']
+    env = dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+    return lambda: subprocess.check_call(command, env=env)
+
+
+def case_sanitize_sms_1kb():
+    sms = _sms(KB)
+    return lambda: sanitize(dict(sms))
+
+
+def case_sanitize_incoming_message_1kb():
+    sms = _sms(KB)
+    return lambda: sanitize_incoming_message(dict(sms))
+
+
+def case_xml_to_dict_sms_1kb():
+    xml = _sms_xml(KB)
+    keys = ('id', 'from', 'to', 'message', 'timestamp')
+    return lambda: xml_to_dict(xml, keys)
+
+
+def case_oauth2_call():
+    auth = OAuth2('079b8f16c9a159c0d7e2fb0fcfe58d40')
+    request = requests.Request('POST', 'https://live-api.bluevia.com/sms/v2/smsoutbound').prepare()
+    return lambda: auth(request)
+
+
+def case_sniff_content_type_jpeg():
+    # Content-Type of MMS file attachments, found out from their first bytes
+    return lambda: sniff_content_type(JPEG_HEADER)
+
+
+def case_sniff_content_type_mp4():
+    # MP4 is the last format looked for
+    return lambda: sniff_content_type(MP4_HEADER)
+
+
+def _case_build_mms(size):
+    metadata = {'to': 'tel:+34600000000', 'subject': 'Photo'}
+    attachment = _mms_attachment_file(size)
+
+    def build():
+        attachment.seek(0)
+        body = build_mms_body(metadata, [u'Look at this picture', ('image/jpeg', attachment)])
+        # Read the body as requests does when sending it
+        while body.read(65536):
+            pass
+    return build
+
+
+def _case_build_mms_template(size):
+    # The per-recipient cost of an MMS broadcast, whose attachments are encoded once
+    metadata = {'to': 'tel:+34600000000', 'subject': 'Photo'}
+    template = MmsTemplate([u'Look at this picture', ('image/jpeg', _mms_attachment_file(size))])
+
+    def build():
+        body = build_mms_body(metadata, template)
+        while body.read(65536):
+            pass
+    return build
+
+
+def _case_parse_mms(size):
+    content_type, body = _mms_body(size)
+    # Parse the body while it's downloaded, as get_incoming_mms_details() does
+    chunks = [body[i:i + 65536] for i in range(0, len(body), 65536)]
+    return lambda: parse_mms_body(content_type, iter(chunks))
+
+
+def case_build_mms_100kb():
+    return _case_build_mms(100 * KB)
+
+
+def case_build_mms_1mb():
+    return _case_build_mms(MB)
+
+
+def case_build_mms_10mb():
+    return _case_build_mms(10 * MB)
+
+
+def case_build_mms_template_100kb():
+    return _case_build_mms_template(100 * KB)
+
+
+def case_build_mms_template_1mb():
+    return _case_build_mms_template(MB)
+
+
+def case_parse_mms_100kb():
+    return _case_parse_mms(100 * KB)
+
+
+def case_parse_mms_1mb():
+    return _case_parse_mms(MB)
+
+
+def case_parse_mms_10mb():
+    return _case_parse_mms(10 * MB)
+
+
+def case_make_request_send_sms():
+    api = _canned_api(201, '{"id": "97286813874922402286"}')
+    return lambda: api.send_sms(to='34600000000', message='Hello world!')
+
+
+def case_make_request_get_incoming_sms_1kb():
+    api = _canned_api(200, json.dumps([_sms(KB)]))
+    return lambda: api.get_incoming_sms()
+
+
+def case_make_request_get_incoming_sms_batch_100():
+    # A full inbound batch, as polling apps under load get
+    api = _canned_api(200, json.dumps([dict(_sms(KB), id=unicode(i)) for i in range(100)]))
+    return lambda: api.get_incoming_sms()
+
+
+def case_parse_notification_delivery_status():
+    content = json.dumps({'id': '97286813874922402286', 'address': 'tel:+34600000000', 'status': 'delivered'})
+    return lambda: parse_notification('application/json;charset=UTF-8', content)
+
+
+def case_parse_notification_sms_1kb():
+    content = json.dumps(_sms(KB))
+    return lambda: parse_notification('application/json;charset=UTF-8', content)
+
+
+# Case names, in the order they are defined
+CASES = [name[len('case_'):] for name in sorted((name for name in globals() if name.startswith('case_')),
+                                                key=lambda name: globals()[name].__code__.co_firstlineno)]
+
+
+def _memory_status():
+    # Current and peak resident set size (in KB) of this process, from /proc (Linux only)
+    status = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                status[line[:5]] = int(line.split()[1])
+    return status['VmRSS'], status['VmHWM']
+
+
+def _measure_peak_memory(func):
+
+    """Return how much the resident set size (in KB) grows over its size before calling func. """
+
+    try:
+        # Reset the peak resident set size, so the memory used while preparing the case is not taken into account
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        before = _memory_status()[0]
+        func()
+        return _memory_status()[1] - before
+    except (IOError, KeyError):
+        # ru_maxrss cannot be reset, so the peak is only detected if it is over the one reached while preparing
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func()
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        # ru_maxrss is in bytes in OS X
+        return peak_memory // 1024 if sys.platform == 'darwin' else peak_memory
+
+
+def run_case(name):
+
+    """Run a case in this process, returning its time per call (in seconds) and peak memory (in KB). """
+
+    func = globals()['case_' + name]()
+    peak_memory = _measure_peak_memory(func)
+    return {'time': measure(func, repeat=5), 'peak_memory': peak_memory}
+
+
+def run_case_in_subprocess(name, json_library=None):
+    command = [sys.executable, os.path.abspath(__file__), '--run-case', name]
+    if json_library:
+        command += ['--json', json_library]
+    output = subprocess.check_output(command)
+    return json.loads(output)
+
+
+def compare(result, baseline, tolerance, memory_tolerance, memory_floor):
+
+    """Return the list of regressions of a result with respect to its baseline. """
+
+    regressions = []
+    if result['time'] > baseline['time'] * (1 + tolerance):
+        regressions.append('time {0:.1f}% over baseline'.format((result['time'] / baseline['time'] - 1) * 100))
+    # Growths under the noise floor are ignored, however big they are relative to a small baseline
+    growth = result['peak_memory'] - baseline['peak_memory']
+    if growth > memory_floor and result['peak_memory'] > baseline['peak_memory'] * (1 + memory_tolerance):
+        regressions.append('peak memory {0} KB over baseline'.format(growth))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark suite of pyBlueVia hot paths.')
+    parser.add_argument('cases', nargs='*', metavar='case', help='cases to run (default: all): ' + ', '.join(CASES))
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as baselines')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown with respect to baselines (default: %(default)s)')
+    parser.add_argument('--memory-tolerance', type=float, default=0.5,
+                        help='allowed peak memory growth with respect to baselines (default: %(default)s)')
+    parser.add_argument('--memory-floor', type=int, default=4096,
+                        help='peak memory growth (in KB) always taken as noise (default: %(default)s)')
+    parser.add_argument('--baselines', default=BASELINES, help='baselines file (default: %(default)s)')
+    parser.add_argument('--attempts', type=int, default=3,
+                        help='times a case is run before reporting it as a regression (default: %(default)s)')
+    parser.add_argument('--json', choices=('ujson', 'simplejson', 'json'),
+                        help='JSON library used by pyBlueVia (default: the one it picks)')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        if args.json:
+            set_json_codec(args.json)
+        print json.dumps(run_case(args.run_case))
+        return 0
+
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error('unknown cases: ' + ', '.join(sorted(unknown)))
+
+    try:
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+    except IOError:
+        baselines = {}
+        if not args.save_baseline:
+            print 'No baselines saved in {0} (run with --save-baseline to save them)'.format(args.baselines)
+
+    failed = False
+    print '{0:<40} {1:>14} {2:>12}  {3}'.format('case', 'time', 'peak memory', 'baseline')
+    for name in args.cases or CASES:
+        result = run_case_in_subprocess(name, args.json)
+        line = '{0:<40} {1:>11.2f} us {2:>9} KB  '.format(name, result['time'] * 1e6, result['peak_memory'])
+        if args.save_baseline:
+            baselines[name] = result
+            line += 'saved'
+        elif name not in baselines:
+            line += 'none'
+        else:
+            regressions = compare(result, baselines[name], args.tolerance, args.memory_tolerance,
+                                  args.memory_floor)
+            for attempt in range(args.attempts - 1):
+                if not regressions:
+                    break
+                # Discard outliers due to the noise of the machine, keeping the best results
+                retry = run_case_in_subprocess(name, args.json)
+                result = {key: min(result[key], retry[key]) for key in result}
+                regressions = compare(result, baselines[name], args.tolerance, args.memory_tolerance,
+                                      args.memory_floor)
+            line += 'REGRESSION: ' + ', '.join(regressions) if regressions else \
+                '{0:.2f}x'.format(baselines[name]['time'] / result['time'])
+            failed = failed or bool(regressions)
+        print line
+
+    if args.save_baseline:
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -39,6 +39,16 @@ __copyright__ = u'2013 Telefonica Investigación y Desarrollo, S.A.U'
 
 from .api import Api
 from .api import SMS_MT, MMS_MT
+from .async_api import AsyncApi
+from .polling import DeliveryTracker, InboundPoller
+from .resilience import RetryPolicy, RateLimiter, CircuitBreaker
+from .records import IncomingSms, IncomingMms, DeliveryStatus
+from .utils import MmsTemplate
+from .recipients import RecipientList, normalize_recipient
+from .notifications import NotificationReceiver, NotificationServer
+from .archive import replay_archive, write_archive_record
+from .tokens import TokenStore, MemoryTokenStore, SqliteTokenStore
+from .jsoncodec import JsonCodec, get_json_codec, set_json_codec
 from .exceptions import *
 
 import logging
@@ -13,10 +13,10 @@ This module implements the pyBlueVia API class.
 
 import logging
 #import uuid
-import urllib
 import urlparse
 
 from .base_api import BaseApi
+from .utils import OAuth2
 from .exceptions import AuthResponseError
 
 
@@ -41,6 +41,18 @@ class Api(BaseApi):
         the OAuth authorization process when calling :meth:`get_access_token`.
     :param sandbox: (optional) set to ``True`` in order to use the BlueVia Sandbox feature. Default is ``False``.
     :type sandbox: bool
+    :param pool_group: (optional) name of the connection pool group this object belongs to. Objects in the same
+        group share a connection pool, which can be configured through :meth:`configure_pool`. By default, all
+        objects share the same connection pool.
+    :param records: (optional) set to ``True`` to get incoming messages and delivery statuses as lightweight
+        records (:class:`IncomingSms`, :class:`IncomingMms` and :class:`DeliveryStatus`) instead of dictionaries.
+        Records are read as dictionaries, but use much less memory. Default is ``False``.
+    :param base_url: (optional) base URL of the BlueVia API (ending with ``/``), overriding the live or sandbox
+        one, e.g. to make requests to a :class:`~bluevia.fakeserver.FakeBlueVia` server.
+    :param token_store: (optional) :class:`TokenStore` where *access tokens* are kept, so they are shared with
+        other objects (and processes, depending on the store) acting on behalf of the same user. If no
+        *access token* is provided, it is looked for in the store when a request needs it.
+    :param user: (optional) identifier of the user (in your app) whose *access token* is kept in *token_store*.
 
     Usage::
 
@@ -59,11 +71,17 @@ class Api(BaseApi):
         'access_token': 'oauth2/token'
     }
 
-    def __init__(self, client_id, client_secret, access_token=None, sandbox=False):
-        base_url = self._SB_API_BASE_URL if sandbox else self._API_BASE_URL
-        self.auth_base_url = self._AUTH_BASE_URL
+    def __init__(self, client_id, client_secret, access_token=None, sandbox=False, pool_group=None, records=False,
+                 base_url=None, token_store=None, user=None):
+        if base_url:
+            # Both the API and the Authorization Server are served from there (e.g. by a FakeBlueVia server)
+            self.auth_base_url = base_url
+        else:
+            base_url = self._SB_API_BASE_URL if sandbox else self._API_BASE_URL
+            self.auth_base_url = self._AUTH_BASE_URL
 
-        BaseApi.__init__(self, base_url, client_id, client_secret, access_token=access_token)
+        BaseApi.__init__(self, base_url, client_id, client_secret, access_token=access_token, pool_group=pool_group,
+                         records=records, token_store=token_store, user=user)
 
         self.sandbox = sandbox
         self.oauth_redirect_uri = self.oauth_state = None
@@ -122,6 +140,7 @@ class Api(BaseApi):
             self.oauth_state = state
             params['state'] = state
 
+        import urllib
         uri = self.auth_base_url + 'authorize?' + urllib.urlencode(params)
         log.info('Authorization URI: ' + uri)
 
@@ -206,6 +225,11 @@ class Api(BaseApi):
         :returns: The *access token* to be used to call BlueVia APIs, valid for the requested *scopes*. The returned
             access token is also stored in the :attr:`access_token` attribute.
 
+        If the object has a :attr:`token_store`, the *access token* is kept there too, replacing the one stored
+        for the user (if any). Concurrent calls for the same user and *authorization code* from the threads of a
+        process wait for a single exchange instead of making their own (an *authorization code* can only be
+        exchanged once). Calls with different *authorization codes* are never merged.
+
         Usage::
 
             >>> import bluevia
@@ -229,10 +253,17 @@ class Api(BaseApi):
         if redirect_uri:
             data['redirect_uri'] = redirect_uri
 
-        resp = self._make_request(url, data, url_encoded=True, basic_auth=True)
+        def exchange():
+            resp = self._make_request(url, data, url_encoded=True, basic_auth=True)
+            return resp['access_token']
 
-        access_token = resp['access_token']
-        self.access_token = access_token  # Calls property on BaseApi class
+        if self.token_store:
+            access_token = self.token_store.acquire(self.client_id, self.user, exchange, authorization_code)
+            # Already stored by the token store
+            self.oauth2 = OAuth2(access_token)
+        else:
+            access_token = exchange()
+            self.access_token = access_token  # Calls property on BaseApi class
 
         return access_token
 
@@ -257,6 +288,77 @@ class Api(BaseApi):
         """
         return BaseApi.send_sms(self, from_=None, to=to, message=message, callback_url=callback_url)
 
+    def send_sms_batch(self, messages, concurrency=None, ordered=True):
+        """Send a batch of SMS concurrently.
+
+        Messages are sent by a bounded pool of threads sharing the connection pool, so many SMS can be
+        in flight at the same time. A failure sending one message does not abort the rest of the batch.
+
+        :param messages: an iterable of messages, each of them being a dictionary with the arguments
+            accepted by :meth:`send_sms` (``to``, ``message`` and, optionally, ``callback_url``) or a tuple
+            with those arguments in the same order.
+        :param concurrency: (optional) maximum number of SMS being sent at the same time. It defaults to
+            (and cannot exceed) the size of the connection pool.
+        :param ordered: (optional) if ``True`` (the default) results are returned in the same order as
+            messages were submitted; if ``False`` they are returned as soon as each sending finishes.
+        :returns: An iterator of tuples (one per message) containing:
+
+            * the index of the message in *messages*.
+            * the SMS id returned by :meth:`send_sms`, or the exception (usually an :exc:`APIError`)
+              raised when sending that message.
+
+        .. note:: This method needs an *access token*.
+
+        Usage::
+
+            >>> import bluevia
+            >>> bluevia_client = bluevia.Api(CLIENT_ID, CLIENT_SECRET, ACCESS_TOKEN)
+            >>> messages = [('34600000000', 'Hello world!'), ('34600000001', 'Hello again!')]
+            >>> for index, result in bluevia_client.send_sms_batch(messages, concurrency=5):
+            ...     print index, result
+            0 97286813874922402286
+            1 API error: [400 Bad Request] SVC0004: Invalid value in 'to' field
+
+        """
+        return BaseApi.send_sms_batch(self, messages, concurrency=concurrency, ordered=ordered)
+
+    def broadcast_sms(self, recipients, message, callback_url=None, concurrency=None, ordered=True):
+        """Send the same SMS to many recipients concurrently.
+
+        SMS are sent by a bounded pool of threads sharing the connection pool. A failure sending to one
+        recipient does not abort the rest of them. Pass a :class:`RecipientList` to reject malformed and
+        duplicated recipients locally, before anything is sent.
+
+        :param recipients: an iterable of phone numbers (or obfuscated identities), or a :class:`RecipientList`.
+        :param message: the SMS text.
+        :param callback_url: (optional) if included, BlueVia will send delivery status notifications to
+            that URL, that could be parsed using :meth:`parse_delivery_status`.
+        :param concurrency: (optional) maximum number of SMS being sent at the same time. It defaults to
+            (and cannot exceed) the size of the connection pool.
+        :param ordered: (optional) if ``True`` (the default) results are returned in the same order as
+            recipients; if ``False`` they are returned as soon as each sending finishes.
+        :returns: An iterator of tuples (one per recipient) containing:
+
+            * the index of the recipient in *recipients*.
+            * the SMS id returned by :meth:`send_sms`, or the exception (usually an :exc:`APIError`)
+              raised when sending to that recipient.
+
+        .. note:: This method needs an *access token*.
+
+        Usage::
+
+            >>> import bluevia
+            >>> bluevia_client = bluevia.Api(CLIENT_ID, CLIENT_SECRET, ACCESS_TOKEN)
+            >>> recipients = bluevia.RecipientList(['34600000000', '+34 600 000 001', '34600000000'])
+            >>> for index, result in bluevia_client.broadcast_sms(recipients, 'Hello world!'):
+            ...     print recipients.positions[index], result
+            0 97286813874922402286
+            1 97286813874922402287
+
+        """
+        return BaseApi.broadcast_sms(self, recipients, message, callback_url=callback_url,
+                                     concurrency=concurrency, ordered=ordered)
+
     def get_sms_delivery_status(self, sms_id):
         """Ask for the delivery status of a sent SMS.
 
@@ -317,12 +419,13 @@ class Api(BaseApi):
         :param attachments: a list of attachments to be sent inside the MMS. Each attachment can be:
 
             * A string, if the attachment is textual content.
-            * A file-like object.
+            * A file-like object, whose *content type* is found out from its first bytes (or its file name).
             * A tuple with two elements:
 
-              * A string with the attachment's *content type*.
-              * The attachment's binary content.
+              * A string with the attachment's *content type* (or ``None`` to find it out from the content).
+              * The attachment's binary content (or a file-like object to read it from).
 
+            It can also be an :class:`MmsTemplate` with the attachments already encoded.
         :param callback_url: (optional) if included, BlueVia will send delivery status notifications to
             that URL, that could be parsed using :meth:`parse_delivery_status`.
         :returns: A unique id representing the sent MMS. It can be used to call :meth:`get_mms_delivery_status`.
@@ -343,6 +446,46 @@ class Api(BaseApi):
         return BaseApi.send_mms(self, from_=None, to=to, subject=subject,
                                 attachments=attachments, callback_url=callback_url)
 
+    def broadcast_mms(self, recipients, subject, attachments, callback_url=None, concurrency=None, ordered=True):
+        """Send the same MMS to many recipients concurrently.
+
+        Attachments are validated and encoded only once (see :class:`MmsTemplate`), instead of once per
+        recipient, and MMS are sent by a bounded pool of threads sharing the connection pool. A failure
+        sending to one recipient does not abort the rest of them. Pass a :class:`RecipientList` to reject
+        malformed and duplicated recipients locally, before anything is sent.
+
+        :param recipients: an iterable of phone numbers (or obfuscated identities), or a :class:`RecipientList`.
+        :param subject: the MMS subject.
+        :param attachments: the attachments, as accepted by :meth:`send_mms`, or an :class:`MmsTemplate`.
+        :param callback_url: (optional) if included, BlueVia will send delivery status notifications to
+            that URL, that could be parsed using :meth:`parse_delivery_status`.
+        :param concurrency: (optional) maximum number of MMS being sent at the same time. It defaults to
+            (and cannot exceed) the size of the connection pool.
+        :param ordered: (optional) if ``True`` (the default) results are returned in the same order as
+            recipients; if ``False`` they are returned as soon as each sending finishes.
+        :returns: An iterator of tuples (one per recipient) containing:
+
+            * the index of the recipient in *recipients*.
+            * the MMS id returned by :meth:`send_mms`, or the exception (usually an :exc:`APIError`)
+              raised when sending to that recipient.
+
+        .. note:: This method needs an *access token*.
+
+        Usage::
+
+            >>> import bluevia
+            >>> bluevia_client = bluevia.Api(CLIENT_ID, CLIENT_SECRET, ACCESS_TOKEN)
+            >>> results = bluevia_client.broadcast_mms(['34600000000', '34600000001'], 'Hello world!',
+            ...                                        ('Look at this picture', open('picture.gif', 'rb')))
+            >>> for index, result in results:
+            ...     print index, result
+            0 2515357468066729
+            1 2515357468066730
+
+        """
+        return BaseApi.broadcast_mms(self, recipients, subject, attachments, callback_url=callback_url,
+                                     concurrency=concurrency, ordered=ordered)
+
     def get_mms_delivery_status(self, mms_id):
         """Ask for the delivery status of a sent MMS.
 
@@ -410,6 +553,9 @@ class Api(BaseApi):
               * the attachment's *content type*.
               * the attachment's binary content.
 
+        The MMS is parsed while it is downloaded. Attachments bigger than :attr:`attachment_spool_threshold`
+        bytes (if set) are returned as temporary files instead of strings.
+
         Usage::
 
             >>> import bluevia
@@ -421,3 +567,32 @@ class Api(BaseApi):
 
         """
         return BaseApi.get_incoming_mms_details(self, mms_id=mms_id)
+
+    def get_incoming_mms_full(self, concurrency=None):
+        """Get the content (metadata and attachments) of all the incoming MMS that have not been retrieved yet.
+
+        It gets the list of incoming MMS ids (see :meth:`get_incoming_mms`) and then gets the content of each
+        MMS (see :meth:`get_incoming_mms_details`) concurrently through a bounded pool of threads, returning
+        each MMS as soon as its download finishes.
+
+        :param concurrency: (optional) maximum number of MMS being downloaded at the same time. It defaults to
+            (and cannot exceed) the size of the connection pool.
+        :returns: An iterator of tuples (one per MMS) containing:
+
+            * the MMS id.
+            * a dictionary with the MMS content (see :meth:`get_incoming_mms_details`), or the exception
+              raised when getting it (usually an :exc:`APIError`, or a :exc:`ValueError` if its content is
+              malformed). MMS ids are removed from BlueVia once listed, so a failing MMS does not stop the
+              rest of them from being returned.
+
+        Usage::
+
+            >>> import bluevia
+            >>> bluevia_client = bluevia.Api(CLIENT_ID, CLIENT_SECRET)
+            >>> for mms_id, mms in bluevia_client.get_incoming_mms_full(concurrency=5):
+            ...     print mms_id, mms['subject']
+            2515357468066729 keyword Photo
+            2515357468066730 keyword Another photo
+
+        """
+        return BaseApi.get_incoming_mms_full(self, concurrency=concurrency)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""
+bluevia.archive
+~~~~~~~~~~~~~~~
+
+This module implements the archiving of raw notifications sent by BlueVia, and their bulk parsing
+(e.g. to reprocess them for reconciliation) on a pool of processes.
+
+Two archive formats are supported:
+
+* ``'jsonl'``: a JSON object per line, with *content_type* and *body* keys (and optionally *kind* and
+  *encoding*, which is ``'base64'`` when the body is base64 encoded, as MMS notifications are).
+* ``'length-prefixed'``: a sequence of records, each of them being the length of the *Content-Type*
+  (as a 4-byte big-endian integer), the *Content-Type*, the length of the body and the body.
+
+:copyright: (c) 2013 Telefonica Investigación y Desarrollo, S.A.U.
+:license: Apache 2.0, see LICENSE for more details.
+
+"""
+
+import base64
+import collections
+import logging
+import struct
+
+from . import jsoncodec
+from .exceptions import BVException
+from .notifications import parse_notification, _guess_kind
+
+
+log = logging.getLogger(__name__)
+
+
+FORMATS = ('jsonl', 'length-prefixed')
+
+_LENGTH = struct.Struct('!I')
+
+
+def write_archive_record(fileobj, content_type, content, format='jsonl'):
+
+    """Append a notification to an archive.
+
+    :param fileobj: the archive, as a file-like object open for writing (in binary mode).
+    :param content_type: the *Content-Type* of the notification.
+    :param content: the body of the notification.
+    :param format: (optional) ``'jsonl'`` (the default) or ``'length-prefixed'``.
+
+    """
+
+    if format == 'jsonl':
+        record = {'content_type': content_type}
+        if content_type.startswith('multipart/'):
+            record['body'] = base64.b64encode(content)
+            record['encoding'] = 'base64'
+        else:
+            record['body'] = content.decode('utf-8') if isinstance(content, str) else content
+        fileobj.write(jsoncodec.dumps(record) + '\n')
+    elif format == 'length-prefixed':
+        if isinstance(content_type, unicode):
+            content_type = content_type.encode('utf-8')
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        fileobj.write(_LENGTH.pack(len(content_type)) + content_type + _LENGTH.pack(len(content)) + content)
+    else:
+        raise ValueError("'format' must be one of: {0}".format(', '.join(FORMATS)))
+
+
+def _read_records(fileobj, format):
+
+    """Yield the raw records of an archive: lines for ``'jsonl'`` archives, and (Content-Type, body) tuples
+    for ``'length-prefixed'`` ones.
+
+    """
+
+    if format == 'jsonl':
+        for line in fileobj:
+            if line.strip():
+                yield line
+    elif format == 'length-prefixed':
+        while True:
+            header = fileobj.read(_LENGTH.size)
+            if not header:
+                return
+            if len(header) < _LENGTH.size:
+                raise ValueError('Truncated archive')
+            length = _LENGTH.unpack(header)[0]
+            content_type = fileobj.read(length)
+            if len(content_type) < length:
+                raise ValueError('Truncated archive')
+            header = fileobj.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                raise ValueError('Truncated archive')
+            length = _LENGTH.unpack(header)[0]
+            content = fileobj.read(length)
+            if len(content) < length:
+                raise ValueError('Truncated archive')
+            yield content_type, content
+    else:
+        raise ValueError("'format' must be one of: {0}".format(', '.join(FORMATS)))
+
+
+def _decode_record(record):
+
+    """Return the (Content-Type, body, kind) of a raw record. """
+
+    if isinstance(record, tuple):
+        return record[0], record[1], None
+
+    try:
+        record = jsoncodec.loads(record)
+        content_type, content = record['content_type'], record['body']
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('Bad JSON record in archive')
+    if record.get('encoding') == 'base64':
+        content = base64.b64decode(content)
+    elif isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return content_type.encode('utf-8'), content, record.get('kind')
+
+
+def _parse_batch(batch, records):
+
+    """Parse a batch of raw records, returning a (kind, notification) tuple for each one, the notification
+    being the exception raised when parsing it if it failed.
+
+    """
+
+    results = []
+    for record in batch:
+        kind = None
+        try:
+            content_type, content, kind = _decode_record(record)
+            kind = kind or _guess_kind(content_type, content)
+            results.append(parse_notification(content_type, content, kind, records))
+        except (BVException, ValueError) as e:
+            results.append((kind, e))
+        except Exception as e:
+            # A single bad record must not abort the replay of the whole archive
+            log.exception('Unexpected error parsing archived {0} notification'.format(kind))
+            results.append((kind, e))
+    return results
+
+
+def _batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def replay_archive(archive, format='jsonl', processes=None, batch_size=500, window=None, records=False):
+
+    """Parse all the notifications in an archive, on a pool of processes.
+
+    The archive is read in batches of *batch_size* notifications, which are parsed by the pool. At most
+    *window* batches are read ahead, so the memory used does not depend on the size of the archive.
+
+    :param archive: the path of the archive, or a file-like object to read it from (in binary mode).
+    :param format: (optional) ``'jsonl'`` (the default) or ``'length-prefixed'``.
+    :param processes: (optional) number of processes parsing notifications. It defaults to the number of CPUs.
+        If it is ``0``, notifications are parsed in the calling process.
+    :param batch_size: (optional) number of notifications sent to a process at once. Default is 500.
+    :param window: (optional) maximum number of batches read ahead. Default is twice the number of processes.
+    :param records: (optional) if ``True``, notifications are parsed into records (see :class:`IncomingSms`)
+        instead of dictionaries. Default is ``False``.
+    :returns: A generator of (index, kind, notification) tuples, in the same order as notifications are in
+        the archive. *kind* is ``'delivery_status'``, ``'sms'`` or ``'mms'`` (or ``None`` if unknown) and
+        *notification* is what :meth:`Api.parse_delivery_status`, :meth:`Api.parse_incoming_sms` or
+        :meth:`Api.parse_incoming_mms` returns (or the exception raised when parsing it).
+
+    Usage::
+
+        >>> import bluevia
+        >>> for index, kind, notification in bluevia.replay_archive('notifications.jsonl'):
+        ...     print index, kind, notification
+        0 delivery_status {u'status': u'delivered', u'id': u'97286813874922402286', u'address': u'34600000000'}
+
+    """
+
+    if format not in FORMATS:
+        raise ValueError("'format' must be one of: {0}".format(', '.join(FORMATS)))
+
+    fileobj = open(archive, 'rb') if isinstance(archive, basestring) else archive
+    pool = None
+    try:
+        batches = _batches(_read_records(fileobj, format), batch_size)
+        index = 0
+
+        if processes == 0:
+            for batch in batches:
+                for kind, notification in _parse_batch(batch, records):
+                    yield index, kind, notification
+                    index += 1
+            return
+
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        window = window or 2 * (processes or multiprocessing.cpu_count())
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.apply_async(_parse_batch, (batch, records)))
+            if len(pending) < window:
+                continue
+            for kind, notification in pending.popleft().get():
+                yield index, kind, notification
+                index += 1
+        while pending:
+            for kind, notification in pending.popleft().get():
+                yield index, kind, notification
+                index += 1
+    finally:
+        if pool:
+            pool.terminate()
+        if fileobj is not archive:
+            fileobj.close()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""
+bluevia.async_api
+~~~~~~~~~~~~~~~~~
+
+This module implements the pyBlueVia non-blocking API class.
+
+:copyright: (c) 2013 Telefonica Investigación y Desarrollo, S.A.U.
+:license: Apache 2.0, see LICENSE for more details.
+
+"""
+
+import logging
+import os
+import threading
+
+from .api import Api
+
+
+log = logging.getLogger(__name__)
+
+
+class AsyncApi(object):
+
+    """This is the non-blocking version of the :class:`Api` class.
+
+    It offers the same methods as :class:`Api`, but those making a request to BlueVia return immediately
+    an ``AsyncResult`` object (see `multiprocessing.pool.AsyncResult
+    <http://docs.python.org/2/library/multiprocessing.html#multiprocessing.pool.AsyncResult>`_) instead of
+    blocking until the response is received. Its ``get()`` method returns the same result (or raises the same
+    exception) as the equivalent :class:`Api` method.
+
+    Requests are made by a pool of threads shared among all :class:`AsyncApi` objects, which in turn share
+    the connection pool with :class:`Api` objects, so authentication, body building and response processing
+    are exactly the same.
+
+    pyBlueVia supports Python 2, which has no ``asyncio``, so this is not an event-loop based API: results
+    cannot be awaited, and there are at most as many requests in flight as threads in the pool (by default,
+    the size of the connection pool, which is 10). Further requests are queued until a thread is free. To
+    have more requests in flight, set the number of threads with :meth:`configure_workers` (and enlarge the
+    connection pool to the same size with :meth:`Api.configure_pool`, so every thread keeps its connection).
+
+    It takes the same parameters as :class:`Api`.
+
+    Usage::
+
+        >>> import bluevia
+        >>> bluevia_client = bluevia.AsyncApi(CLIENT_ID, CLIENT_SECRET, ACCESS_TOKEN)
+        >>> results = [bluevia_client.send_sms(to=to, message='Hello world!') for to in recipients]
+        >>> sms_ids = [result.get() for result in results]
+
+    """
+
+    #: Number of threads making requests to BlueVia, i.e. the maximum number of requests in flight (see
+    #: :meth:`configure_workers`). If not set, it is the size of the connection pool.
+    workers = None
+
+    # The worker pool is a class attribute so it is shared among all instances of AsyncApi.
+    # It is created on first use, and created again in a forked child process.
+    _pool = None
+    _pool_pid = None
+    _pool_lock = threading.Lock()
+
+    def __init__(self, client_id, client_secret, access_token=None, sandbox=False, pool_group=None, records=False,
+                 base_url=None, token_store=None, user=None):
+        self.api = Api(client_id, client_secret, access_token=access_token, sandbox=sandbox, pool_group=pool_group,
+                       records=records, base_url=base_url, token_store=token_store, user=user)
+
+    def __getattr__(self, name):
+        # Methods not making requests to BlueVia (and attributes) are taken from the wrapped Api object
+        if name == 'api':
+            raise AttributeError(name)
+        return getattr(self.api, name)
+
+    @property
+    def access_token(self):
+        """ OAuth *access token* (see :attr:`Api.access_token`). """
+        return self.api.access_token
+
+    @access_token.setter
+    def access_token(self, access_token):
+        self.api.access_token = access_token
+
+    @staticmethod
+    def configure_workers(workers=None):
+
+        """Set the number of threads making requests to BlueVia for all :class:`AsyncApi` objects, independently
+        of the size of the connection pool.
+
+        Requests already submitted are made by the previous threads, which finish once they are done.
+
+        :param workers: (optional) number of threads, i.e. the maximum number of requests in flight. By default,
+            the size of the connection pool.
+
+        Usage::
+
+            >>> import bluevia
+            >>> bluevia.Api.configure_pool(pool_maxsize=200)
+            >>> bluevia.AsyncApi.configure_workers(200)
+
+        """
+
+        if workers is not None and workers < 1:
+            raise ValueError("'workers' must be at least 1")
+        with AsyncApi._pool_lock:
+            AsyncApi.workers = workers
+            pool = AsyncApi._pool if AsyncApi._pool_pid == os.getpid() else None
+            AsyncApi._pool = None
+            AsyncApi._pool_pid = None
+        if pool is not None:
+            # Let the threads finish the requests already submitted
+            pool.close()
+
+    def _worker_pool(self):
+        with AsyncApi._pool_lock:
+            if AsyncApi._pool is None or AsyncApi._pool_pid != os.getpid():
+                from multiprocessing.pool import ThreadPool
+                workers = AsyncApi.workers or self.api._pool_size()
+                log.info('Creating a pool of {0} workers'.format(workers))
+                AsyncApi._pool = ThreadPool(workers)
+                AsyncApi._pool_pid = os.getpid()
+            return AsyncApi._pool
+
+    def _submit(self, method, *args, **kwargs):
+        return self._worker_pool().apply_async(method, args, kwargs)
+
+    def get_access_token(self, authorization_code, redirect_uri=None):
+        """Non-blocking version of :meth:`Api.get_access_token`. """
+        return self._submit(self.api.get_access_token, authorization_code, redirect_uri=redirect_uri)
+
+    def send_sms(self, to, message, callback_url=None):
+        """Non-blocking version of :meth:`Api.send_sms`. """
+        return self._submit(self.api.send_sms, to, message, callback_url=callback_url)
+
+    def get_sms_delivery_status(self, sms_id):
+        """Non-blocking version of :meth:`Api.get_sms_delivery_status`. """
+        return self._submit(self.api.get_sms_delivery_status, sms_id)
+
+    def get_incoming_sms(self):
+        """Non-blocking version of :meth:`Api.get_incoming_sms`. """
+        return self._submit(self.api.get_incoming_sms)
+
+    def send_mms(self, to, subject, attachments, callback_url=None):
+        """Non-blocking version of :meth:`Api.send_mms`. """
+        return self._submit(self.api.send_mms, to, subject, attachments, callback_url=callback_url)
+
+    def get_mms_delivery_status(self, mms_id):
+        """Non-blocking version of :meth:`Api.get_mms_delivery_status`. """
+        return self._submit(self.api.get_mms_delivery_status, mms_id)
+
+    def get_incoming_mms(self):
+        """Non-blocking version of :meth:`Api.get_incoming_mms`. """
+        return self._submit(self.api.get_incoming_mms)
+
+    def get_incoming_mms_details(self, mms_id):
+        """Non-blocking version of :meth:`Api.get_incoming_mms_details`. """
+        return self._submit(self.api.get_incoming_mms_details, mms_id)
+
+    parse_delivery_status = staticmethod(Api.parse_delivery_status)
+    parse_incoming_sms = staticmethod(Api.parse_incoming_sms)
+    parse_incoming_mms = staticmethod(Api.parse_incoming_mms)
+    parse_authorization_response = staticmethod(Api.parse_authorization_response)
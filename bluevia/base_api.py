@@ -11,18 +11,46 @@ This module implements the base class to be extended by subclases that implement
 
 """
 
+import itertools
 import logging
-import json
+import threading
+import time
+import urlparse
 
-import requests
-from requests.auth import HTTPBasicAuth
-
-from .utils import OAuth2, build_mms_body, parse_mms_body, xml_to_dict, sanitize
-from .exceptions import APIError, AccessTokenError, ContentTypeError
+from .utils import OAuth2, MmsTemplate, build_mms_body, parse_mms_body, xml_to_dict
+from .utils import sanitize_incoming_message, sanitize_delivery_status
+from .resilience import RetryPolicy
+from .recipients import to_address
+from . import jsoncodec
+from .records import IncomingSms, IncomingMms, DeliveryStatus
+from .exceptions import BVException, APIError, AccessTokenError, ContentTypeError
 
 
 log = logging.getLogger(__name__)
 
+# Same as requests.adapters.DEFAULT_POOLSIZE, which is not imported so requests is only imported when needed
+DEFAULT_POOLSIZE = 10
+
+
+def _new_session():
+    # requests is imported here (and wherever it is used) instead of at module level, so importing pyBlueVia
+    # is fast for apps (e.g. short-lived jobs, or processes only parsing notifications) not making requests yet
+    import requests
+    session = requests.Session()
+    session.verify = True
+    return session
+
+
+class _LazySession(object):
+
+    """ Class attribute whose session is created on first use, replacing the attribute """
+
+    def __get__(self, instance, owner):
+        with BaseApi._session_lock:
+            if isinstance(BaseApi.__dict__['session'], _LazySession):
+                BaseApi.session = _new_session()
+        return BaseApi.session
+
 
 class BaseApi(object):
 
@@ -46,25 +74,76 @@ class BaseApi(object):
     # and its subclasses.
     # Note that each subclass instance has its own client_id, client_secret, access token and ssl_client_cert,
     # so each instance deals with a set of credentials, while sharing the connection pool.
-    session = requests.Session()
-    session.verify = True
+    # It's created on first use.
+    session = _LazySession()
+    _session_lock = threading.Lock()
 
-    def __init__(self, base_url, client_id, client_secret, access_token=None, ssl_client_cert=None):
+    # Instances created with a pool group use its session (and so its connection pool) instead of the default one
+    _pool_groups = {}
+
+    # Connections kept open to each host, as set by configure_pool: {(pool_group, URL prefix): pool_maxsize}
+    _pool_sizes = {}
+
+    #: Size (in bytes) above which incoming MMS attachments are returned as temporary files instead of strings.
+    #: If ``None`` (the default) attachments are always returned as strings.
+    attachment_spool_threshold = None
+
+    #: :class:`RetryPolicy` applied to failed requests. By default, GET requests are retried up to 2 times and
+    #: POST requests only if BlueVia has not processed them. Set it to ``None`` to disable retries.
+    retry_policy = RetryPolicy()
+
+    #: :class:`RateLimiter` that requests wait for before being made. By default, there is no rate limit.
+    rate_limiter = None
+
+    #: :class:`CircuitBreaker` which makes requests to failing endpoints fail fast. By default, there is none.
+    #: Setting it on the class (e.g. ``Api.circuit_breaker = CircuitBreaker()``) shares it among all the objects.
+    circuit_breaker = None
+
+    #: Seconds to wait for BlueVia to accept the connection and to send data, or ``None`` (the default) to wait
+    #: forever. It can also be a (connect timeout, read timeout) tuple.
+    timeout = None
+
+    def __init__(self, base_url, client_id, client_secret, access_token=None, ssl_client_cert=None, pool_group=None,
+                 records=False, token_store=None, user=None):
         self.base_url = base_url
-        self.http_ba = HTTPBasicAuth(client_id, client_secret)
+        self._pool_group = pool_group or None
+        if pool_group:
+            self.session = BaseApi._pool_session(pool_group)
+        self._client_credentials = (client_id, client_secret)
+        #: :class:`TokenStore` where the *access token* is looked for (if not set) and stored, or ``None``.
+        self.token_store = token_store
+        #: Identifier of the user (in your app) whose *access token* is kept in :attr:`token_store`.
+        self.user = user
         if access_token:
-            self.oauth2 = OAuth2(access_token)
+            self.access_token = access_token
         self.ssl_client_cert = ssl_client_cert
+        #: Number of requests made by this object and number of retries they needed, as a dictionary
+        #: with *requests* and *retries* keys.
+        self.retry_stats = {'requests': 0, 'retries': 0}
+        self._retry_stats_lock = threading.Lock()
+        #: Whether incoming messages and delivery statuses are returned as records (e.g. :class:`IncomingSms`)
+        #: instead of dictionaries.
+        self.records = records
 
     @property
     def client_id(self):
         """ OAuth *client id* set when creating the :class:`Api` object (read only). """
-        return self.http_ba.username
+        return self._client_credentials[0]
 
     @property
     def client_secret(self):
         """ OAuth *client secret* set when creating the :class:`Api` object (read only). """
-        return self.http_ba.password
+        return self._client_credentials[1]
+
+    @property
+    def http_ba(self):
+        # Created on first use, as requests is not imported until a request is made
+        try:
+            return self._http_ba
+        except AttributeError:
+            from requests.auth import HTTPBasicAuth
+            self._http_ba = HTTPBasicAuth(*self._client_credentials)
+            return self._http_ba
 
     @property
     def access_token(self):
@@ -75,17 +154,210 @@ class BaseApi(object):
         try:
             return self.oauth2.access_token
         except AttributeError:
-            return None
+            pass
+        if self.token_store:
+            access_token = self.token_store.get(self.client_id, self.user)
+            if access_token:
+                self.oauth2 = OAuth2(access_token)
+                return access_token
+        return None
 
     @access_token.setter
     def access_token(self, access_token):
         if access_token:
             self.oauth2 = OAuth2(access_token)
+            if self.token_store:
+                self.token_store.set(self.client_id, self.user, access_token)
+
+    @staticmethod
+    def _pool_session(pool_group=None):
+
+        """ Return the session of a pool group, creating it if needed """
+
+        if not pool_group:
+            return BaseApi.session
+        if pool_group not in BaseApi._pool_groups:
+            BaseApi._pool_groups[pool_group] = _new_session()
+        return BaseApi._pool_groups[pool_group]
+
+    @staticmethod
+    def configure_pool(pool_maxsize=DEFAULT_POOLSIZE, pool_block=False, keep_alive=True, url=None,
+                       pool_group=None):
+
+        """Configure the connection pool shared by all the objects in a pool group.
+
+        :param pool_maxsize: (optional) maximum number of connections kept open to each host.
+            Default is 10.
+        :param pool_block: (optional) if ``True``, a request waits for a free connection when *pool_maxsize*
+            connections are in use; otherwise (the default) a new connection is opened, and discarded
+            after the request.
+        :param keep_alive: (optional) if ``False``, connections are closed after each request. Default is ``True``.
+        :param url: (optional) if provided, the configuration only applies to requests whose URL starts with it
+            (e.g. ``'https://live-api.bluevia.com/'``), so each host can have its own pool configuration.
+        :param pool_group: (optional) name of the pool group to configure. By default, the pool shared by all the
+            objects created without a pool group is configured.
+
+        """
+
+        from requests.adapters import HTTPAdapter
+
+        session = BaseApi._pool_session(pool_group)
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize, pool_block=pool_block)
+        for prefix in [url] if url else ['https://', 'http://']:
+            session.mount(prefix, adapter)
+            BaseApi._pool_sizes[(pool_group or None, prefix)] = pool_maxsize
+        # Adapters are looked up in order, so longest prefixes must go first (not done by old requests versions)
+        session.adapters = type(session.adapters)(sorted(session.adapters.items(), key=lambda item: -len(item[0])))
+
+        if keep_alive:
+            session.headers.pop('Connection', None)
+        else:
+            session.headers['Connection'] = 'close'
+
+    def pool_stats(self):
+
+        """Return the utilization of the connection pools used by this object.
+
+        :returns: A dictionary with an entry per host (as ``scheme://host:port``), each of them being a
+            dictionary with the following keys:
+
+            * *maxsize*: maximum number of connections kept open to the host.
+            * *in_use*: number of connections being used right now.
+            * *idle*: number of open connections waiting to be used.
+            * *connections*: number of connections opened since the pool was created.
+            * *requests*: number of requests made since the pool was created.
+
+        """
+
+        stats = {}
+        adapters = set(self.session.adapters.values())
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                host = '{0}://{1}:{2}'.format(pool.scheme, pool.host, pool.port)
+                queue = pool.pool
+                if queue is None:
+                    # The pool has been closed
+                    continue
+                stats[host] = {'maxsize': queue.maxsize,
+                               'in_use': queue.maxsize - queue.qsize(),
+                               'idle': len([conn for conn in list(queue.queue) if conn]),
+                               'connections': pool.num_connections,
+                               'requests': pool.num_requests}
+
+        return stats
+
+    def _pool_size(self):
+
+        """ Return the maximum number of connections kept by the pool used to reach the API host """
+
+        # The longest URL prefix configured for the pool group wins, as it does when mounting adapters
+        prefixes = [prefix for group, prefix in BaseApi._pool_sizes
+                    if group == self._pool_group and self.base_url.startswith(prefix)]
+        if not prefixes:
+            return DEFAULT_POOLSIZE
+        return BaseApi._pool_sizes[(self._pool_group, max(prefixes, key=len))]
+
+    def _imap(self, func, items, concurrency=None, ordered=True):
+
+        """Call func for every item on a bounded pool of threads and yield (index, result) tuples.
+
+        The pool never has more threads than connections in the connection pool, so every worker can
+        reuse a connection instead of opening (and discarding) a new one.
+        Results are yielded in submission order if ordered is True, or as soon as they are available otherwise.
+        Errors raised by func are yielded as results, so a failing item does not abort the rest of them.
+        Items are read from the iterable as results are yielded, never more than twice as many as threads ahead
+        of them, so huge iterables (e.g. generators of the messages of a campaign) are not held in memory.
+
+        """
+
+        import requests
+        from multiprocessing.pool import ThreadPool
+        from Queue import Queue
+
+        pool_size = self._pool_size()
+        concurrency = min(concurrency or pool_size, pool_size)
 
-    def _make_request(self, url, data=None, attachments=None, url_encoded=False, basic_auth=False):
+        def call(args):
+            index, item = args
+            try:
+                return index, func(item)
+            except (BVException, requests.RequestException) as e:
+                log.info('Item #{0} failed: {1}'.format(index, e))
+                return index, e
+            except Exception as e:
+                # A malformed item (or response) must not abort the items still in flight either
+                log.exception('Item #{0} failed unexpectedly'.format(index))
+                return index, e
+
+        # ThreadPool.imap would read the whole iterable at once, so tasks are submitted through a bounded window
+        tasks = enumerate(items)
+        window = 2 * concurrency
+        done = Queue()
+
+        def submit(count):
+            submitted = 0
+            for args in itertools.islice(tasks, count):
+                pool.apply_async(call, (args,), callback=done.put)
+                submitted += 1
+            return submitted
+
+        pool = ThreadPool(concurrency)
+        try:
+            pending = submit(window)
+            # Results waiting for earlier ones to be yielded (if ordered): {index: result}
+            finished = {}
+            next_index = 0
+            while pending:
+                index, result = done.get()
+                if not ordered:
+                    pending -= 1
+                    yield index, result
+                    pending += submit(1)
+                    continue
+                finished[index] = result
+                while next_index in finished:
+                    pending -= 1
+                    yield next_index, finished.pop(next_index)
+                    next_index += 1
+                    pending += submit(1)
+        finally:
+            pool.terminate()
+
+    def _retry_delay(self, method, retries, body, resp=None, error=None):
+
+        """ Return the seconds to wait before retrying a failed request, or None if it must not be retried """
+
+        if not self.retry_policy:
+            return None
+        delay = self.retry_policy.get_delay(method, retries, resp=resp, error=error)
+        # A streamed body can only be sent again if it can be read again from the beginning
+        if delay is not None and body is not None and not body.rewind():
+            return None
+        return delay
+
+    def _count_retries(self, retries):
+        with self._retry_stats_lock:
+            self.retry_stats['requests'] += 1
+            self.retry_stats['retries'] += retries
+
+    def _endpoint(self, url):
+
+        """ Return the name of the endpoint a URL belongs to (e.g. 'smsoutbound') """
+
+        paths = dict(self._PATHS, **getattr(self, 'PATHS', {}))
+        for name, path in paths.iteritems():
+            if path in url:
+                return name
+        return 'other'
+
+    def _make_request(self, url, data=None, attachments=None, url_encoded=False, basic_auth=False, stream=False):
 
         """ Build the API request and return the formatted result of the API call """
 
+        import requests
+
         # Choose the authentication method
         if self.ssl_client_cert:
             auth = self.http_ba
@@ -93,55 +365,104 @@ class BaseApi(object):
             try:
                 auth = self.http_ba if basic_auth else self.oauth2
             except AttributeError:
-                # self.oauth2 has not been set because there is not an access_token
-                raise AccessTokenError('Access Token has not been set')
+                # self.oauth2 has not been set because there is not an access_token, unless it is in the token store
+                if not self.access_token:
+                    raise AccessTokenError('Access Token has not been set')
+                auth = self.oauth2
 
         # Build the request depending on the input parameters
+        body = None
         if not data:
             # GET
-            log.info('GETting from URL: {url}'.format(url=url))
-            resp = BaseApi.session.get(url=url, auth=auth, cert=self.ssl_client_cert)
+            method = 'GET'
         elif isinstance(data, dict):
             # POST
+            method = 'POST'
             if not attachments:
                 # It's not an MMS
                 if not url_encoded:
                     # Simple JSON body
                     headers = {'content-type': 'application/json'}
-                    data = json.dumps(data, ensure_ascii=False)
+                    data = jsoncodec.dumps(data)
                 else:
                     # Data passed to Requests as a dictionary is automatically sent as url encoded
                     # and the proper content-type header is automatically set
                     headers = None
             else:
-                # Multipart body (MMS)
+                # Multipart body (MMS), streamed while it's sent
                 body = build_mms_body(data, attachments)
-                data = body.as_string().split('\n\n', 1)[1]  # Skipping MIME headers
-                # get_content_type() and get_boundary() don't work until as_string() is called
-                headers = {'content-type': body.get_content_type() + '; boundary="' + body.get_boundary() + '"'}
-
-            log.info(('POSTting to URL: {url}\n'
-                      '  with body: {body}').format(url=url, body=data))
-            resp = BaseApi.session.post(url=url, data=data, headers=headers, auth=auth,
-                                        cert=self.ssl_client_cert)
+                headers = {'content-type': body.content_type}
         else:
             raise TypeError("'data' param must be None or a dict")
 
+        endpoint = self._endpoint(url)
+        circuit = urlparse.urlparse(url).netloc + '/' + endpoint
+        retries = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire(self.client_id, endpoint)
+            circuit_breaker = self.circuit_breaker
+            trial = circuit_breaker.before_call(circuit) if circuit_breaker else False
+            start = time.time()
+            # Whether the endpoint worked, or None if the request failed for another reason
+            success = None
+            duration = None
+            try:
+                if method == 'GET':
+                    log.info('GETting from URL: {url}'.format(url=url))
+                    resp = self.session.get(url=url, auth=auth, cert=self.ssl_client_cert, stream=stream,
+                                            timeout=self.timeout)
+                else:
+                    if body is not None:
+                        # If the body length is unknown, it is sent using chunked transfer encoding
+                        data = body if body.len is not None else iter(body)
+                    log.info(('POSTting to URL: {url}\n'
+                              '  with body: {body}').format(url=url, body=data if body is None else
+                                                            '<multipart body, {0} bytes>'.format(body.len)))
+                    resp = self.session.post(url=url, data=data, headers=headers, auth=auth,
+                                             cert=self.ssl_client_cert, timeout=self.timeout)
+                success, duration = resp.status_code < 500, time.time() - start
+            except requests.RequestException as e:
+                success, duration = False, time.time() - start
+                delay = self._retry_delay(method, retries, body, error=e)
+                if delay is None:
+                    self._count_retries(retries)
+                    raise
+                log.warning('Request to {0} failed ({1}), retrying in {2:.2f}s'.format(url, e, delay))
+            else:
+                delay = self._retry_delay(method, retries, body, resp=resp)
+                if delay is None:
+                    break
+                # Read the body, so the connection is released to the pool
+                resp.content
+                log.warning('Request to {0} failed ({1} {2}), retrying in {3:.2f}s'.format(url, resp.status_code,
+                                                                                         resp.reason, delay))
+            finally:
+                # Whatever happened, so the trial slot of a half-open circuit is always released
+                if circuit_breaker:
+                    circuit_breaker.record(circuit, success, duration, trial)
+            retries += 1
+            time.sleep(delay)
+
+        self._count_retries(retries)
+
         log_str = ('Response:\n'
                    '  Status code: {status_code}\n'
                    '  Headers: {headers}\n'
                    '  Body: {body}\n'
+                   '  Retries: {retries}\n'
                    '  Client id: {client_id}').format(status_code=resp.status_code,
                                                       headers=resp.headers,
-                                                      body=resp.content,
-                                                      client_id=self.http_ba.username)
+                                                      body=resp.content if not stream else '<streamed>',
+                                                      retries=retries,
+                                                      client_id=self.client_id)
         if hasattr(self, 'oauth2'):
             log_str += '\n  Access token: {access_token}'.format(access_token=self.oauth2.access_token)
         log.info(log_str)
 
         # Process response
         if resp.status_code in (200, 201):
-            if resp.headers['content-length'] == '0':
+            if resp.headers.get('content-length') == '0':
                 return None
 
             content_type = resp.headers['content-type']
@@ -149,9 +470,12 @@ class BaseApi(object):
                 raise ContentTypeError("HTTP response does not contain a Content-Type header")
 
             if content_type.lower().startswith('application/json'):
-                return resp.json()
+                return jsoncodec.loads(resp.content)
             elif content_type.lower().startswith('multipart/mixed'):
-                metadata, attachments = parse_mms_body(content_type, resp.content)
+                # A streamed body is parsed while it's downloaded
+                metadata, attachments = parse_mms_body(content_type,
+                                                       resp.iter_content(65536) if stream else resp.content,
+                                                       spool_threshold=self.attachment_spool_threshold)
                 return metadata, attachments
             else:
                 raise ContentTypeError("Unsupported Content-Type '{0}' in HTTP response"
@@ -159,7 +483,9 @@ class BaseApi(object):
         elif resp.status_code == 204:
             return None
         else:
-            raise APIError(resp)
+            error = APIError(resp)
+            error.retries = retries
+            raise error
 
     def send_sms(self, from_, to, message, callback_url=None):
 
@@ -172,11 +498,11 @@ class BaseApi(object):
         url = self.base_url + self._PATHS['smsoutbound']
 
         # If 'to' contains only digits, it's an MSISDN, else it's an obfuscated identity
-        data = {'to': 'tel:+' + to if to.isdigit() else 'alias:' + to,
+        data = {'to': to_address(to),
                 'message': message}
         # If 'from_' contains only digits, it's an MSISDN, else it's a sender name
         if from_:
-            data['from'] = 'tel:+' + from_ if from_.isdigit() else 'alias:' + from_
+            data['from'] = to_address(from_)
         if callback_url:
             data['callbackUrl'] = callback_url
 
@@ -184,6 +510,42 @@ class BaseApi(object):
 
         return resp['id']
 
+    def send_sms_batch(self, messages, concurrency=None, ordered=True):
+
+        """Base method to send a batch of SMS concurrently.
+
+        Each message is a dict (or a tuple) with the arguments to be passed to :meth:`send_sms`, which
+        is called on a bounded pool of threads. It yields (index, result) tuples, where result is
+        either the SMS id or the exception raised when sending that message.
+
+        This method can be extended by child classes to implement batch SMS sending.
+
+        """
+
+        def send(message):
+            if isinstance(message, dict):
+                return self.send_sms(**message)
+            else:
+                return self.send_sms(*message)
+
+        return self._imap(send, messages, concurrency, ordered)
+
+    def broadcast_sms(self, recipients, message, callback_url=None, concurrency=None, ordered=True):
+
+        """Base method to send the same SMS to many recipients concurrently.
+
+        :meth:`send_sms` is called for each recipient on a bounded pool of threads. It yields (index, result)
+        tuples, where result is either the SMS id or the exception raised when sending to that recipient.
+
+        This method can be extended by child classes to implement SMS broadcasting.
+
+        """
+
+        def send(to):
+            return self.send_sms(to=to, message=message, callback_url=callback_url)
+
+        return self._imap(send, recipients, concurrency, ordered)
+
     def get_sms_delivery_status(self, sms_id):
 
         """Base method to ask for the delivery status of a sent SMS.
@@ -199,12 +561,13 @@ class BaseApi(object):
 
         resp = self._make_request(url)
 
-        return sanitize(resp['to'][0])
+        delivery_status = sanitize_delivery_status(resp['to'][0])
+        return DeliveryStatus(delivery_status) if self.records else delivery_status
 #        return [{u'to': to['address'][6:] if to['address'].startswith('alias:') else to['address'][5:],
 #                 u'status': to['status']} for to in resp['to']]
 
     @staticmethod
-    def parse_delivery_status(content_type, content):
+    def parse_delivery_status(content_type, content, records=False):
 
         """Parse a delivery status notification sent by BlueVia to your app.
 
@@ -214,6 +577,8 @@ class BaseApi(object):
 
         :param content_type: the *Content Type* of the request sent by BlueVia to the *callback URL*.
         :param content: the entire body of the request sent by BlueVia to the *callback URL*.
+        :param records: (optional) if ``True``, a :class:`DeliveryStatus` record is returned instead of
+            a dictionary.
         :returns: A dictionary with the following keys:
 
             * *id*: SMS/MMS id (the same returned when sending the message).
@@ -231,11 +596,12 @@ class BaseApi(object):
 
         if content_type.startswith('application/json'):
             try:
-                delivery_status = json.loads(content)
+                delivery_status = jsoncodec.loads(content)
             except ValueError:
                 raise ValueError('Bad JSON content')
 
-            return sanitize(delivery_status)
+            delivery_status = sanitize_delivery_status(delivery_status)
+            return DeliveryStatus(delivery_status) if records else delivery_status
 #            delivery_status[u'address'] = delivery_status['address'][6:]\
 #                                          if delivery_status['address'].startswith('alias:')\
 #                                          else delivery_status['address'][5:]
@@ -257,7 +623,9 @@ class BaseApi(object):
         resp = self._make_request(url, basic_auth=True)
 
         if resp:
-            return sanitize(resp)
+            if self.records:
+                return [IncomingSms(sanitize_incoming_message(sms)) for sms in resp]
+            return [sanitize_incoming_message(sms) for sms in resp]
 #            return [{u'id': sms['id'],
 #                     u'from': sms['from'][6:] if sms['from'].startswith('alias:') else sms['from'][5:],
 #                     u'obfuscated': sms['from'].startswith('alias:'),
@@ -268,7 +636,7 @@ class BaseApi(object):
             return []
 
     @staticmethod
-    def parse_incoming_sms(content_type, content):
+    def parse_incoming_sms(content_type, content, records=False):
 
         """Parse an SMS notification sent by BlueVia to your app.
 
@@ -278,6 +646,8 @@ class BaseApi(object):
         :param content_type: the *Content Type* of the request sent by BlueVia to the provisioned URL.
             Both ``application/json`` and ``application/xml`` are supported.
         :param content: the entire body of the request sent by BlueVia to the provisioned URL.
+        :param records: (optional) if ``True``, an :class:`IncomingSms` record is returned instead of
+            a dictionary.
         :returns: A dictionary with the following keys:
 
             * *id*: SMS id.
@@ -298,7 +668,7 @@ class BaseApi(object):
 
         if content_type.startswith('application/json'):
             try:
-                sms = json.loads(content)
+                sms = jsoncodec.loads(content)
             except ValueError:
                 raise ValueError('Bad JSON content')
         elif content_type.startswith('application/xml'):
@@ -310,7 +680,8 @@ class BaseApi(object):
             raise ContentTypeError("Unsupported Content-Type '{0}' "
                                    "(only application/json and application/xml are supported".format(content_type))
 
-        return sanitize(sms)
+        sms = sanitize_incoming_message(sms)
+        return IncomingSms(sms) if records else sms
 #        sms[u'obfuscated'] = sms['from'].startswith('alias:')
 #        sms[u'from'] = sms['from'][6:] if sms['obfuscated'] else sms['from'][5:]
 #        sms[u'to'] = sms['to'][5:]
@@ -329,11 +700,11 @@ class BaseApi(object):
         url = self.base_url + self._PATHS['mmsoutbound']
 
         # If 'to' contains only digits, it's an MSISDN, else it's an obfuscated identity
-        metadata = {'to': 'tel:+' + to if to.isdigit() else 'alias:' + to,
+        metadata = {'to': to_address(to),
                     'subject': subject}
         # If 'from_' contains only digits, it's an MSISDN, else it's a sender name
         if from_:
-            metadata['from'] = 'tel:+' + from_ if from_.isdigit() else 'alias:' + from_
+            metadata['from'] = to_address(from_)
         if callback_url:
             metadata['callbackUrl'] = callback_url
 
@@ -341,6 +712,26 @@ class BaseApi(object):
 
         return resp['id']
 
+    def broadcast_mms(self, recipients, subject, attachments, callback_url=None, concurrency=None, ordered=True):
+
+        """Base method to send the same MMS to many recipients concurrently.
+
+        Attachments are encoded once into an :class:`MmsTemplate` (unless they already are one), and
+        :meth:`send_mms` is called for each recipient on a bounded pool of threads. It yields (index, result)
+        tuples, where result is either the MMS id or the exception raised when sending to that recipient.
+
+        This method can be extended by child classes to implement MMS broadcasting.
+
+        """
+
+        if not isinstance(attachments, MmsTemplate):
+            attachments = MmsTemplate(attachments)
+
+        def send(to):
+            return self.send_mms(to=to, subject=subject, attachments=attachments, callback_url=callback_url)
+
+        return self._imap(send, recipients, concurrency, ordered)
+
     def get_mms_delivery_status(self, mms_id):
 
         """Base method to ask for the delivery status of a sent SMS.
@@ -356,7 +747,8 @@ class BaseApi(object):
 
         resp = self._make_request(url)
 
-        return sanitize(resp['to'][0])
+        delivery_status = sanitize_delivery_status(resp['to'][0])
+        return DeliveryStatus(delivery_status) if self.records else delivery_status
 #        return [{u'to': to['address'][6:] if to['address'].startswith('alias:') else to['address'][5:],
 #                 u'status': to['status']} for to in resp['to']]
 
@@ -389,11 +781,11 @@ class BaseApi(object):
         # TODO: Test MMS w/o attachments
         url = self.base_url + self._PATHS['mmsinbound'] + '/' + mms_id
 
-        metadata, attachments = self._make_request(url, basic_auth=True)
+        metadata, attachments = self._make_request(url, basic_auth=True, stream=True)
 
-        mms = sanitize(metadata)
+        mms = sanitize_incoming_message(metadata)
         mms[u'attachments'] = attachments
-        return mms
+        return IncomingMms(mms) if self.records else mms
 #        return {u'id': metadata['id'],
 #                u'from': metadata['from'][6:] if metadata['from'].startswith('alias:')
 #                         else metadata['from'][5:],
@@ -403,8 +795,26 @@ class BaseApi(object):
 #                u'timestamp': datetime.strptime(metadata['timestamp'], '%Y-%m-%dT%H:%M:%S.%f+0000'),
 #                u'attachments': attachments}
 
+    def get_incoming_mms_full(self, concurrency=None):
+
+        """Base method to get the content of all the incoming MMS.
+
+        It gets the list of incoming MMS ids and then gets their contents concurrently, yielding
+        (MMS id, result) tuples as soon as each download finishes. The result is either the MMS content
+        (as returned by :meth:`get_incoming_mms_details`) or the exception raised when getting or parsing it,
+        so a malformed MMS does not lose the rest of them (their ids have already been dequeued from BlueVia).
+
+        This method can be extended by child classes to implement pipelined incoming MMS retrieving.
+
+        """
+
+        mms_ids = self.get_incoming_mms()
+
+        for index, result in self._imap(self.get_incoming_mms_details, mms_ids, concurrency, ordered=False):
+            yield mms_ids[index], result
+
     @staticmethod
-    def parse_incoming_mms(content_type, content):
+    def parse_incoming_mms(content_type, content, content_length=None, spool_threshold=None, records=False):
 
         """Parse a MMS notification sent by BlueVia to your app.
 
@@ -413,7 +823,13 @@ class BaseApi(object):
 
         :param content_type: the *Content Type* of the request sent by BlueVia to the provisioned URL.
         :param content: the entire body of the request sent by BlueVia to the provisioned URL
-            (including the MIME attachments).
+            (including the MIME attachments), or a file-like object to read it from.
+        :param content_length: (optional) number of bytes to read when *content* is a file-like object
+            (e.g. the value of the *Content-Length* header when reading from a socket).
+        :param spool_threshold: (optional) size in bytes above which attachments are returned as temporary
+            files instead of strings.
+        :param records: (optional) if ``True``, an :class:`IncomingMms` record is returned instead of
+            a dictionary.
         :returns: A dictionary with the following keys:
 
             * *id*: MMS id.
@@ -425,7 +841,7 @@ class BaseApi(object):
             * *attachments*: an array of tuples (one per attachment) containing:
 
               * the Content-Type of the attachment.
-              * the attachment itself.
+              * the attachment itself (or a temporary file containing it, see *spool_threshold*).
 
         Usage::
 
@@ -436,11 +852,11 @@ class BaseApi(object):
 
         """
 
-        metadata, attachments = parse_mms_body(content_type, content)
+        metadata, attachments = parse_mms_body(content_type, content, content_length, spool_threshold)
 
-        mms = sanitize(metadata)
+        mms = sanitize_incoming_message(metadata)
         mms[u'attachments'] = attachments
-        return mms
+        return IncomingMms(mms) if records else mms
 #        return {u'id': metadata['id'],
 #                u'from': metadata['from'][6:] if metadata['from'].startswith('alias:')
 #                         else metadata['from'][5:],
@@ -26,8 +26,11 @@ class APIError(BVException):
         self.http_status_code = resp.status_code
         #: a description (if available) of the HTTP status code.
         self.http_reason = resp.reason  # TODO: Corregir acento: Petici�n incorrecta
+        #: number of times the request was retried before giving up (see :attr:`Api.retry_policy`).
+        self.retries = 0
         if resp.headers['content-type'] and resp.headers['content-type'].startswith('application/json'):
-            content = resp.json()
+            from . import jsoncodec
+            content = jsoncodec.loads(resp.content)
             if 'exceptionId' in content:
                 #: the exception id as returned by BlueVia (it might be ``None``).
                 self.id = content['exceptionId']
@@ -62,3 +65,19 @@ class AuthResponseError(BVException):
     """An error occurred trying to parse the URI to which the Authorization Server redirects after finishing
     the authorization process. """
     pass
+
+
+class CircuitOpenError(BVException):
+
+    """The circuit breaker of a BlueVia endpoint is open (because it's failing), so the request has not been made.
+    Details can be got through the following attributes: """
+
+    def __init__(self, endpoint, retry_in):
+        #: the endpoint whose circuit is open.
+        self.endpoint = endpoint
+        #: seconds until the circuit lets a trial request through.
+        self.retry_in = retry_in
+        BVException.__init__(self, endpoint, retry_in)
+
+    def __str__(self):
+        return 'Circuit open for {0} (retry in {1:.1f}s)'.format(self.endpoint, self.retry_in)
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+"""
+bluevia.fakeserver
+~~~~~~~~~~~~~~~~~~
+
+This module implements a local stand-in for the BlueVia API, to run load and integration tests
+without reaching the real one. It can be run from the command line::
+
+    $ python -m bluevia.fakeserver --port 8080 --latency 0.05 --error-rate 0.01 --max-rate 100
+
+:copyright: (c) 2013 Telefonica Investigación y Desarrollo, S.A.U.
+:license: Apache 2.0, see LICENSE for more details.
+
+"""
+
+import logging
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+import urlparse
+import uuid
+from datetime import datetime
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from .utils import build_mms_body, parse_mms_body
+from .exceptions import BVException
+
+
+log = logging.getLogger(__name__)
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def reply(self, status, body='', content_type='application/json', headers=()):
+        # BaseHTTPRequestHandler does not know the reason phrase of 429
+        self.send_response(status, 'Too Many Requests' if status == 429 else None)
+        if body:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_error(self, status, exception_id, text, headers=()):
+        self.reply(status, json.dumps({'exceptionId': exception_id, 'exceptionText': text}), headers=headers)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if not size:
+                    # Skip trailers
+                    while self.rfile.readline().strip():
+                        pass
+                    return ''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def handle_request(self, method):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        path = url.path.strip('/').split('/')
+        body = self.read_body() if method == 'POST' else None
+
+        latency = server.latency
+        if isinstance(latency, (tuple, list)):
+            latency = random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+        if not server.take_token():
+            return self.reply_error(429, 'POL3006', 'Too many requests', headers=[('Retry-After', '1')])
+        if server.error_rate and random.random() < server.error_rate:
+            return self.reply_error(503, 'SVC1000', 'Service temporarily unavailable')
+
+        route = self.route(method, path)
+        if route is None:
+            return self.reply_error(404, 'SVC0002', 'Invalid input value for URL {0}'.format(url.path))
+        handler, auth, args = route
+
+        authorization = self.headers.get('Authorization', '')
+        if auth == 'basic' and not authorization.startswith('Basic '):
+            return self.reply_error(401, 'SVC1000', 'Missing client credentials')
+        if auth == 'bearer' and not authorization.startswith('Bearer '):
+            return self.reply_error(401, 'SVC1000', 'Missing access token')
+
+        handler(body, *args)
+
+    def route(self, method, path):
+
+        """ Return the (handler, authentication, arguments) of a request, or None if there is no such resource. """
+
+        if method == 'POST' and path == ['oauth2', 'token']:
+            return self._token, 'basic', ()
+        if len(path) < 3 or (path[0], path[1]) not in (('sms', 'v2'), ('mms', 'v2')):
+            return None
+        kind, api, rest = path[0], path[2], path[3:]
+        if api == kind + 'outbound':
+            if method == 'POST' and not rest:
+                return self._send, 'bearer', (kind,)
+            if method == 'GET' and len(rest) == 1:
+                return self._delivery_status, 'bearer', (kind, rest[0])
+        elif api == kind + 'inbound' and method == 'GET':
+            if not rest:
+                return self._incoming, 'basic', (kind,)
+            if kind == 'mms' and len(rest) == 1:
+                return self._incoming_mms_details, 'basic', (rest[0],)
+        return None
+
+    def _token(self, body):
+        params = urlparse.parse_qs(body)
+        if params.get('grant_type') != ['authorization_code'] or not params.get('code'):
+            return self.reply(400, json.dumps({'error': 'invalid_request'}))
+        self.reply(200, json.dumps({'access_token': uuid.uuid4().hex, 'token_type': 'bearer'}))
+
+    def _send(self, body, kind):
+        server = self.server
+        try:
+            if kind == 'sms':
+                message = json.loads(body)
+                missing = [key for key in ('to', 'message') if key not in message]
+            else:
+                message, attachments = parse_mms_body(self.headers.get('Content-Type', ''), body)
+                missing = [key for key in ('to', 'subject') if key not in message]
+        except (BVException, ValueError):
+            return self.reply_error(400, 'SVC0001', 'Invalid request body')
+        if missing:
+            return self.reply_error(400, 'SVC0002', 'Invalid input value for message part {0}'.format(missing[0]))
+
+        msg_id = server._next_id()
+        with server._lock:
+            server._sent[(kind, msg_id)] = (message['to'], time.time())
+        location = '{0}{1}/v2/{1}outbound/{2}'.format(server.url, kind, msg_id)
+        self.reply(201, json.dumps({'id': msg_id}), headers=[('Location', location)])
+
+    def _delivery_status(self, body, kind, msg_id):
+        server = self.server
+        with server._lock:
+            sent = server._sent.get((kind, msg_id))
+        if sent is None:
+            return self.reply_error(404, 'SVC0004', 'No valid addresses provided in message part id')
+        to, sent_at = sent
+        status = 'delivered' if time.time() - sent_at >= server.delivery_delay else 'sent'
+        self.reply(200, json.dumps({'to': [{'address': to, 'status': status}]}))
+
+    def _incoming(self, body, kind):
+        server = self.server
+        with server._lock:
+            if kind == 'sms':
+                messages, server._incoming_sms = server._incoming_sms, []
+            else:
+                messages = [{'id': mms_id} for mms_id in server._incoming_mms_ids]
+                server._incoming_mms_ids = []
+        if not messages:
+            return self.reply(204)
+        self.reply(200, json.dumps(messages))
+
+    def _incoming_mms_details(self, body, mms_id):
+        server = self.server
+        with server._lock:
+            mms = server._incoming_mms.pop(mms_id, None)
+        if mms is None:
+            return self.reply_error(404, 'SVC0004', 'No valid MMS id')
+        encoder = build_mms_body(*mms)
+        self.reply(200, encoder.read(), encoder.content_type)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def log_message(self, format, *args):
+        log.debug('{0} - {1}'.format(self.address_string(), format % args))
+
+
+class FakeBlueVia(ThreadingMixIn, HTTPServer):
+
+    """Local HTTP server which behaves as the BlueVia API, for load and integration testing.
+
+    It implements the SMS and MMS APIs (sending, delivery status and incoming messages) and the
+    *access token* request, with the same content types, multipart bodies and error bodies BlueVia uses.
+    Sent messages are stored, so their delivery status can be asked for, and incoming messages are
+    queued calling :meth:`add_incoming_sms` and :meth:`add_incoming_mms`.
+
+    Faults can be injected (and changed at any time through the attributes with the same name):
+
+    :param server_address: (optional) (host, port) tuple to listen to. Default is ``('127.0.0.1', 0)``, which
+        listens to a free port (see :attr:`url`).
+    :param latency: (optional) seconds each request takes, or a (min, max) tuple to take a random latency
+        between them. Default is 0.
+    :param error_rate: (optional) rate (between 0 and 1) of requests failing with a *503* status. Default is 0.
+    :param max_rate: (optional) requests per second above which requests fail with a *429* status and a
+        *Retry-After* header. By default, there is no limit.
+    :param delivery_delay: (optional) seconds after which sent messages are delivered. Before that, their
+        delivery status is ``'sent'``. Default is 0.
+
+    Usage::
+
+        >>> import bluevia
+        >>> from bluevia.fakeserver import FakeBlueVia
+        >>> server = FakeBlueVia(latency=(0.01, 0.1), error_rate=0.05)
+        >>> server.start()
+        >>> bluevia_client = bluevia.Api(CLIENT_ID, CLIENT_SECRET, ACCESS_TOKEN, base_url=server.url)
+        >>> bluevia_client.send_sms(to='34600000000', message='Hello world!')
+        '1000000000000000001'
+
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address=('127.0.0.1', 0), latency=0, error_rate=0, max_rate=None, delivery_delay=0):
+        HTTPServer.__init__(self, server_address, _FakeHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_rate = max_rate
+        self.delivery_delay = delivery_delay
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1000000000000000001)
+        self._tokens = float('inf')
+        self._last_refill = time.time()
+        # Sent messages: {(kind, id): (recipient, sending time)}
+        self._sent = {}
+        self._incoming_sms = []
+        # Incoming MMS: {id: (metadata, attachments)}, and their ids in order of arrival
+        self._incoming_mms = {}
+        self._incoming_mms_ids = []
+
+    @property
+    def url(self):
+        """ Base URL of the server, to be passed as *base_url* to :class:`Api`. """
+        return 'http://{0}:{1}/'.format(*self.server_address[:2])
+
+    def start(self):
+
+        """Serve requests in a background thread, until :meth:`shutdown` is called. """
+
+        thread = threading.Thread(target=self.serve_forever, name='bluevia-fakeserver')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def take_token(self):
+
+        """Return whether a request is allowed by *max_rate* (taking a token from the bucket if so). """
+
+        if not self.max_rate:
+            return True
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.max_rate, self._tokens + (now - self._last_refill) * self.max_rate)
+            self._last_refill = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _next_id(self):
+        with self._lock:
+            return str(next(self._ids))
+
+    @staticmethod
+    def _timestamp():
+        now = datetime.utcnow()
+        return now.strftime('%Y-%m-%dT%H:%M:%S.') + '{0:03d}+0000'.format(now.microsecond // 1000)
+
+    def add_incoming_sms(self, from_, to, message):
+
+        """Queue an incoming SMS, to be returned by the next request of incoming SMS.
+
+        :returns: The id of the SMS.
+
+        """
+
+        sms_id = self._next_id()
+        with self._lock:
+            self._incoming_sms.append({'id': sms_id,
+                                       'from': 'tel:+' + from_ if from_.isdigit() else 'alias:' + from_,
+                                       'to': 'tel:+' + to,
+                                       'message': message,
+                                       'timestamp': self._timestamp()})
+        return sms_id
+
+    def add_incoming_mms(self, from_, to, subject, attachments):
+
+        """Queue an incoming MMS, to be returned by the next request of incoming MMS.
+
+        :param attachments: the attachments, as accepted by :meth:`Api.send_mms`.
+        :returns: The id of the MMS.
+
+        """
+
+        mms_id = self._next_id()
+        metadata = {'id': mms_id,
+                    'from': 'tel:+' + from_ if from_.isdigit() else 'alias:' + from_,
+                    'to': 'tel:+' + to,
+                    'subject': subject,
+                    'timestamp': self._timestamp()}
+        with self._lock:
+            self._incoming_mms[mms_id] = (metadata, attachments)
+            self._incoming_mms_ids.append(mms_id)
+        return mms_id
+
+
+def main(argv=None):
+
+    """Run the fake BlueVia server from the command line. """
+
+    parser = argparse.ArgumentParser(prog='python -m bluevia.fakeserver', description=main.__doc__)
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen to (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen to (default: %(default)s)')
+    parser.add_argument('--latency', type=float, nargs='+', default=[0], metavar='SECONDS',
+                        help='latency of each request, or min and max latency (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0, help='rate of requests failing with a 503 status')
+    parser.add_argument('--max-rate', type=float, help='requests per second above which requests are throttled')
+    parser.add_argument('--delivery-delay', type=float, default=0, metavar='SECONDS',
+                        help='seconds after which sent messages are delivered')
+    args = parser.parse_args(argv)
+
+    server = FakeBlueVia((args.host, args.port), latency=args.latency[0] if len(args.latency) == 1 else args.latency,
+                         error_rate=args.error_rate, max_rate=args.max_rate, delivery_delay=args.delivery_delay)
+    print 'Fake BlueVia listening at {0}'.format(server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+bluevia.jsoncodec
+~~~~~~~~~~~~~~~~~
+
+This module implements the encoding and decoding of every JSON body (requests, responses, notifications,
+MMS metadata and archive records) through the fastest JSON library installed: `ujson`, `simplejson` or,
+if none of them is, the standard library `json` module.
+
+:copyright: (c) 2013 Telefonica Investigación y Desarrollo, S.A.U.
+:license: Apache 2.0, see LICENSE for more details.
+
+"""
+
+import importlib
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+#: JSON libraries looked for, in order of preference.
+JSON_LIBRARIES = ('ujson', 'simplejson', 'json')
+
+
+class JsonCodec(object):
+
+    """A JSON library, wrapped so all of them are used the same way:
+
+    * :meth:`dumps` returns UTF-8 encoded strings, ready to be sent. The JSON documents are equivalent, but not
+      the same: `ujson` sends non-ASCII characters as they are, while the rest escape them (``\\uXXXX``).
+    * :meth:`loads` returns unicode strings, and raises :exc:`ValueError` if the content is not valid JSON.
+
+    What `ujson` cannot handle (e.g. integers which do not fit in 64 bits, which it rejects) is encoded or
+    decoded by the standard library `json` module instead, so the results are the same as with the rest.
+
+    :param library: (optional) name of the JSON library: ``'ujson'``, ``'simplejson'`` or ``'json'``.
+        By default, the first one installed (in that order).
+    :raises: :exc:`ImportError` if the requested library is not installed.
+
+    """
+
+    def __init__(self, library=None):
+        if library is not None and library not in JSON_LIBRARIES:
+            raise ValueError("'library' must be one of: {0}".format(', '.join(JSON_LIBRARIES)))
+
+        for name in [library] if library else JSON_LIBRARIES:
+            try:
+                module = importlib.import_module(name)
+                break
+            except ImportError:
+                if library:
+                    raise
+        #: name of the JSON library.
+        self.library = name
+
+        if name == 'ujson':
+            import json
+
+            try:
+                # Slashes are not escaped, as the standard library does not escape them either
+                module.dumps('/', ensure_ascii=False, escape_forward_slashes=False)
+                options = {'ensure_ascii': False, 'escape_forward_slashes': False}
+            except TypeError:
+                # Old ujson releases do not support that option (escaped slashes are valid JSON anyway)
+                log.debug('ujson {0} escapes forward slashes'.format(getattr(module, '__version__', '')))
+                options = {'ensure_ascii': False}
+
+            def dumps(obj):
+                try:
+                    return module.dumps(obj, **options)
+                except OverflowError:
+                    return json.dumps(obj)
+
+            def loads(content):
+                try:
+                    return module.loads(content)
+                except ValueError:
+                    # Either the content is not valid JSON, which the standard library raises ValueError for
+                    # too, or it contains numbers too big for ujson
+                    return json.loads(content)
+
+            self._dumps = dumps
+            self._loads = loads
+        else:
+            # Non-ASCII characters are escaped, as it's much faster than encoding them (and the output is ASCII,
+            # so it's already UTF-8)
+            self._dumps = module.dumps
+            if name == 'simplejson':
+                # simplejson returns str objects for ASCII strings if the content is a str object
+                self._loads = lambda content: module.loads(content.decode('utf-8') if isinstance(content, str)
+                                                           else content)
+            else:
+                self._loads = module.loads
+
+    def dumps(self, obj):
+
+        """Return the JSON representation of an object, as a UTF-8 encoded string. """
+
+        return self._dumps(obj)
+
+    def loads(self, content):
+
+        """Return the object represented by a JSON document (a UTF-8 encoded or unicode string). """
+
+        return self._loads(content)
+
+    def __repr__(self):
+        return '<JsonCodec: {0}>'.format(self.library)
+
+
+# Chosen when it's first needed, so JSON libraries are only imported then
+_codec = None
+
+
+def get_json_codec():
+
+    """Return the :class:`JsonCodec` used by pyBlueVia. """
+
+    global _codec
+    if _codec is None:
+        _codec = JsonCodec()
+        log.debug('Using {0} to encode and decode JSON'.format(_codec.library))
+    return _codec
+
+
+def set_json_codec(codec=None):
+
+    """Set the JSON library used by pyBlueVia to encode and decode every JSON body.
+
+    :param codec: (optional) a :class:`JsonCodec` object (or any object with the same *dumps* and *loads*
+        methods), or the name of a JSON library (``'ujson'``, ``'simplejson'`` or ``'json'``). By default,
+        the first library installed.
+    :raises: :exc:`ImportError` if the requested library is not installed.
+
+    Usage::
+
+        >>> import bluevia
+        >>> bluevia.set_json_codec('json')
+        >>> bluevia.get_json_codec()
+        <JsonCodec: json>
+
+    """
+
+    global _codec
+    _codec = codec if codec is not None and not isinstance(codec, basestring) else JsonCodec(codec)
+
+
+def dumps(obj):
+    return (_codec or get_json_codec()).dumps(obj)
+
+
+def loads(content):
+    return (_codec or get_json_codec()).loads(content)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+"""
+bluevia.loadtest
+~~~~~~~~~~~~~~~~
+
+This module implements a load test driver, which makes requests through the :class:`Api` class (so results
+reflect the same code paths, connection pooling, retries and parsing your app uses) against a BlueVia API,
+usually a :class:`~bluevia.fakeserver.FakeBlueVia` server. It can be run from the command line::
+
+    $ python -m bluevia.fakeserver --port 8080 --latency 0.01 0.05 &
+    $ python -m bluevia.loadtest send_sms --base-url http://127.0.0.1:8080/ --rate 200 --duration 30
+
+:copyright: (c) 2013 Telefonica Investigación y Desarrollo, S.A.U.
+:license: Apache 2.0, see LICENSE for more details.
+
+"""
+
+import logging
+import argparse
+import collections
+import itertools
+import os
+import threading
+import time
+import urlparse
+
+from requests import RequestException
+
+from .api import Api
+from .exceptions import BVException, APIError
+
+
+log = logging.getLogger(__name__)
+
+
+WORKLOADS = ('send_sms', 'send_mms', 'sms_delivery_status', 'mms_delivery_status', 'incoming_sms',
+             'incoming_mms')
+
+# Messages sent before a delivery status workload, whose delivery status is asked for in turns
+_TRACKED_MESSAGES = 100
+
+
+def _send_tracked(send):
+
+    """ Send the messages whose delivery status is asked for, returning their ids """
+
+    ids = []
+    # Failures are tolerated, as the API under test may inject them
+    for i in range(10 * _TRACKED_MESSAGES):
+        try:
+            ids.append(send())
+        except (BVException, RequestException) as e:
+            log.info('Message not sent: {0}'.format(e))
+        if len(ids) == _TRACKED_MESSAGES:
+            break
+    if not ids:
+        raise BVException('Messages to ask for their delivery status could not be sent')
+    return ids
+
+
+def _workload(api, workload, recipient='34600000000', mms_size=50 * 1024):
+
+    """Return a function making a request of a workload (sending the messages it needs beforehand). """
+
+    if workload == 'send_sms':
+        return lambda: api.send_sms(to=recipient, message='Load test')
+    if workload in ('send_mms', 'mms_delivery_status'):
+        # The same pseudorandom (as compressed images are) attachment is sent in every MMS
+        attachments = [u'Load test', ('image/jpeg', os.urandom(mms_size))]
+        send_mms = lambda: api.send_mms(to=recipient, subject='Load test', attachments=attachments)
+        if workload == 'send_mms':
+            return send_mms
+        ids = itertools.cycle(_send_tracked(send_mms))
+        return lambda: api.get_mms_delivery_status(next(ids))
+    if workload == 'sms_delivery_status':
+        ids = itertools.cycle(_send_tracked(lambda: api.send_sms(to=recipient, message='Load test')))
+        return lambda: api.get_sms_delivery_status(next(ids))
+    if workload == 'incoming_sms':
+        return api.get_incoming_sms
+    if workload == 'incoming_mms':
+        return api.get_incoming_mms
+    raise ValueError("'workload' must be one of: {0}".format(', '.join(WORKLOADS)))
+
+
+def _percentile(latencies, percent):
+    # Nearest-rank percentile of a sorted list
+    if not latencies:
+        return None
+    return latencies[max(0, min(len(latencies) - 1, int(round(percent / 100.0 * len(latencies))) - 1))]
+
+
+def _pool_counters(api):
+
+    """ Return the number of requests made and connections opened by the pool used to reach the API host """
+
+    url = urlparse.urlparse(api.base_url)
+    host = '{0}://{1}:{2}'.format(url.scheme, url.hostname, url.port or (443 if url.scheme == 'https' else 80))
+    stats = api.pool_stats().get(host, {})
+    return stats.get('requests', 0), stats.get('connections', 0)
+
+
+def run_load(api, workload, requests=None, duration=None, rate=None, concurrency=10, **kwargs):
+
+    """Run a workload against the BlueVia API an :class:`Api` object makes requests to.
+
+    Requests are made by *concurrency* threads. If *rate* is set, they are scheduled at that rate, and their
+    latency is measured from the time they were scheduled (not from the time a thread was free to make them),
+    so it includes the time they waited because the API did not keep up with the rate. Otherwise, each thread
+    makes a request as soon as the previous one finishes.
+
+    :param api: the :class:`Api` object. Its connection pool should keep at least *concurrency* connections
+        (see :meth:`Api.configure_pool`).
+    :param workload: ``'send_sms'``, ``'send_mms'``, ``'sms_delivery_status'``, ``'mms_delivery_status'``,
+        ``'incoming_sms'`` or ``'incoming_mms'``. Delivery status workloads send some messages beforehand,
+        asking for their delivery status in turns.
+    :param requests: (optional) number of requests to make.
+    :param duration: (optional) seconds to make requests for. If neither *requests* nor *duration* are set,
+        10 seconds.
+    :param rate: (optional) requests per second to make.
+    :param concurrency: (optional) number of threads making requests. Default is 10.
+    :param recipient: (optional) recipient of the messages sent. Default is ``'34600000000'``.
+    :param mms_size: (optional) size in bytes of the attachment of the MMS sent. Default is 50 KB.
+    :returns: A dictionary with the following keys:
+
+        * *requests*: number of requests made.
+        * *errors*: number of failed requests, as a dictionary whose keys are the HTTP status of the failed
+          requests, or the name of the exception raised if there was no response (e.g. ``'ConnectionError'``)
+          or it could not be handled (e.g. ``'ValueError'``).
+        * *duration*: seconds taken by the test.
+        * *throughput*: requests per second (successful or not).
+        * *latency*: a dictionary with the *p50*, *p95*, *p99* and *max* latencies, in seconds.
+        * *retries*: number of retries made (see :attr:`Api.retry_policy`).
+        * *connections*: number of connections opened.
+        * *connection_reuse*: rate (between 0 and 1) of requests made through an already open connection.
+
+    Usage::
+
+        >>> import bluevia
+        >>> from bluevia.loadtest import run_load
+        >>> bluevia_client = bluevia.Api(CLIENT_ID, CLIENT_SECRET, ACCESS_TOKEN, base_url='http://127.0.0.1:8080/')
+        >>> results = run_load(bluevia_client, 'send_sms', duration=30, rate=200)
+        >>> results['throughput'], results['latency']['p99']
+        (199.87, 0.0512)
+
+    """
+
+    if duration is None and requests is None:
+        duration = 10
+    call = _workload(api, workload, **kwargs)
+
+    latencies = []
+    errors = collections.Counter()
+    lock = threading.Lock()
+    slots = itertools.count()
+    requests_before, connections_before = _pool_counters(api)
+    retries_before = api.retry_stats['retries']
+    start = time.time()
+
+    def work():
+        while True:
+            with lock:
+                slot = next(slots)
+            if requests is not None and slot >= requests:
+                return
+            if rate:
+                scheduled = start + slot / float(rate)
+                if duration is not None and scheduled >= start + duration:
+                    return
+                wait = scheduled - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            else:
+                scheduled = time.time()
+                if duration is not None and scheduled >= start + duration:
+                    return
+            try:
+                call()
+                error = None
+            except APIError as e:
+                error = e.http_status_code
+            except (BVException, RequestException) as e:
+                error = type(e).__name__
+            except Exception as e:
+                # Any other error (e.g. a malformed response) must neither kill the worker nor go unreported.
+                # It's counted like the rest, so it's only logged in debug mode, as there may be lots of them
+                log.debug('Request failed unexpectedly', exc_info=True)
+                error = type(e).__name__
+            latency = time.time() - scheduled
+            with lock:
+                latencies.append(latency)
+                if error is not None:
+                    errors[error] += 1
+
+    threads = [threading.Thread(target=work, name='bluevia-loadtest-{0}'.format(i)) for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Join with a timeout, so the test can be interrupted with Ctrl-C
+        while thread.is_alive():
+            thread.join(0.5)
+    elapsed = time.time() - start
+
+    requests_after, connections_after = _pool_counters(api)
+    pool_requests = requests_after - requests_before
+    connections = connections_after - connections_before
+    latencies.sort()
+    return {'requests': len(latencies),
+            'errors': dict(errors),
+            'duration': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            'latency': {'p50': _percentile(latencies, 50),
+                        'p95': _percentile(latencies, 95),
+                        'p99': _percentile(latencies, 99),
+                        'max': latencies[-1] if latencies else None},
+            'retries': api.retry_stats['retries'] - retries_before,
+            'connections': connections,
+            'connection_reuse': 1 - float(connections) / pool_requests if pool_requests else 0.0}
+
+
+def format_results(results):
+
+    """Return the results of :func:`run_load` as a human readable report. """
+
+    def ms(seconds):
+        return '-' if seconds is None else '{0:.1f} ms'.format(seconds * 1000)
+
+    lines = ['Requests:         {0} in {1:.1f}s'.format(results['requests'], results['duration']),
+             'Throughput:       {0:.1f} req/s'.format(results['throughput']),
+             'Latency:          p50 {0}, p95 {1}, p99 {2}, max {3}'.format(
+                 *[ms(results['latency'][key]) for key in ('p50', 'p95', 'p99', 'max')]),
+             'Errors:           {0}'.format(sum(results['errors'].values()))]
+    for error, count in sorted(results['errors'].items(), key=lambda item: str(item[0])):
+        lines.append('  {0:<16}{1}'.format(error, count))
+    lines += ['Retries:          {0}'.format(results['retries']),
+              'Connections:      {0} opened, {1:.1%} of requests reused one'.format(results['connections'],
+                                                                                    results['connection_reuse'])]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+
+    """Run a load test against the BlueVia API (or a fake one) from the command line. """
+
+    parser = argparse.ArgumentParser(prog='python -m bluevia.loadtest', description=main.__doc__)
+    parser.add_argument('workload', choices=WORKLOADS, help='kind of requests to make')
+    parser.add_argument('--base-url', help='base URL of the API (default: a FakeBlueVia server run in this process)')
+    parser.add_argument('--client-id', default='CLIENT_ID', help='OAuth client id (default: %(default)s)')
+    parser.add_argument('--client-secret', default='CLIENT_SECRET', help='OAuth client secret (default: %(default)s)')
+    parser.add_argument('--access-token', default='ACCESS_TOKEN', help='OAuth access token (default: %(default)s)')
+    parser.add_argument('--requests', type=int, help='number of requests to make')
+    parser.add_argument('--duration', type=float, metavar='SECONDS', help='seconds to make requests for (default: 10)')
+    parser.add_argument('--rate', type=float, help='requests per second (default: as many as possible)')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='threads making requests, and connections kept open (default: %(default)s)')
+    parser.add_argument('--recipient', default='34600000000', help='recipient of the messages sent')
+    parser.add_argument('--mms-size', type=int, default=50 * 1024, metavar='BYTES',
+                        help='size of the attachment of the MMS sent (default: %(default)s)')
+    parser.add_argument('--no-retries', action='store_true', help='do not retry failed requests')
+    args = parser.parse_args(argv)
+
+    server = None
+    if not args.base_url:
+        from .fakeserver import FakeBlueVia
+        server = FakeBlueVia()
+        server.start()
+        args.base_url = server.url
+
+    Api.configure_pool(pool_maxsize=args.concurrency, pool_group='loadtest')
+    api = Api(args.client_id, args.client_secret, args.access_token, pool_group='loadtest', base_url=args.base_url)
+    if args.no_retries:
+        api.retry_policy = None
+
+    print 'Running {0} against {1}'.format(args.workload, args.base_url)
+    try:
+        results = run_load(api, args.workload, requests=args.requests, duration=args.duration, rate=args.rate,
+                           concurrency=args.concurrency, recipient=args.recipient, mms_size=args.mms_size)
+    finally:
+        if server:
+            # Close the connections first, so the server threads serving them finish
+            api.session.close()
+            server.shutdown()
+            server.server_close()
+    print format_results(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""
+bluevia.notifications
+~~~~~~~~~~~~~~~~~~~~~
+
+This module implements a receiver for the notifications sent by BlueVia to your app (delivery statuses
+and incoming SMS and MMS), which can be run as a WSGI app or through its own HTTP server.
+
+:copyright: (c) 2013 Telefonica Investigación y Desarrollo, S.A.U.
+:license: Apache 2.0, see LICENSE for more details.
+
+"""
+
+import logging
+import re
+import threading
+import Queue
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from .api import Api
+from .exceptions import BVException, ContentTypeError
+from .records import IncomingSms, IncomingMms, DeliveryStatus
+
+
+log = logging.getLogger(__name__)
+
+
+# A "status" key (but not a "status" string value) in a JSON document
+_STATUS_KEY_RE = re.compile(r'(?<!\\)"status"\s*:')
+
+
+def _guess_kind(content_type, content):
+
+    """Return the kind of a notification (``'delivery_status'``, ``'sms'`` or ``'mms'``) from its content,
+    or ``None`` if its *Content-Type* is not supported.
+
+    """
+
+    if content_type.startswith('multipart/'):
+        return 'mms'
+    if content_type.startswith('application/json'):
+        # Delivery statuses are the only notifications with a "status" field
+        return 'delivery_status' if _STATUS_KEY_RE.search(content) else 'sms'
+    if content_type.startswith('application/xml'):
+        return 'sms'
+    return None
+
+
+def parse_notification(content_type, content, kind=None, records=False, spool_threshold=None):
+
+    """Parse a notification of any kind, calling :meth:`Api.parse_delivery_status`, :meth:`Api.parse_incoming_sms`
+    or :meth:`Api.parse_incoming_mms`.
+
+    :param kind: (optional) ``'delivery_status'``, ``'sms'`` or ``'mms'``. By default, it is found out from the
+        content of the notification.
+    :returns: A (kind, notification) tuple.
+    :raises: :exc:`ValueError` if the notification is malformed (e.g. its JSON content is not an object), or
+        :exc:`ContentTypeError` if its *Content-Type* is not supported.
+
+    """
+
+    kind = kind or _guess_kind(content_type, content)
+    # Records are built here, once the parsed content is known to be an object
+    if kind == 'delivery_status':
+        notification, record = Api.parse_delivery_status(content_type, content), DeliveryStatus
+    elif kind == 'sms':
+        notification, record = Api.parse_incoming_sms(content_type, content), IncomingSms
+    elif kind == 'mms':
+        notification = Api.parse_incoming_mms(content_type, content, spool_threshold=spool_threshold)
+        record = IncomingMms
+    else:
+        raise ContentTypeError("Unsupported Content-Type '{0}' in notification".format(content_type))
+    # The parse methods return any other JSON value as it is, which is not a notification
+    if not isinstance(notification, dict):
+        raise ValueError('Bad {0} notification (its content is not an object)'.format(kind))
+    return kind, record(notification) if records else notification
+
+
+class NotificationReceiver(object):
+
+    """Receiver of the notifications sent by BlueVia to your app: delivery statuses (see the *callback_url*
+    parameter of :meth:`Api.send_sms` and :meth:`Api.send_mms`) and incoming SMS and MMS.
+
+    Notifications are answered as soon as they are received, and they are parsed afterwards by a pool
+    of worker threads, which put them in a bounded queue to be consumed through :meth:`events`.
+    When the app does not keep up with the rate of notifications and the queues are full, new ones are
+    answered with a *503 Service Unavailable* status, so BlueVia sends them again later.
+
+    The kind of each notification is found out from its path (if it is in *paths*) or from its content.
+
+    The receiver is a WSGI app, so it can be run by any WSGI server, or by :class:`NotificationServer`.
+
+    :param workers: (optional) number of threads parsing notifications. Default is 4.
+    :param queue_size: (optional) maximum number of notifications waiting to be parsed, and maximum number of
+        parsed notifications waiting to be consumed. Default is 10000.
+    :param paths: (optional) a dictionary with the kind of notification (``'delivery_status'``, ``'sms'`` or
+        ``'mms'``) received at each path (e.g. ``{'/delivery_status': 'delivery_status'}``).
+    :param records: (optional) if ``True``, notifications are parsed into records (see :class:`IncomingSms`)
+        instead of dictionaries. Default is ``False``.
+    :param spool_threshold: (optional) size in bytes above which MMS attachments are returned as temporary
+        files instead of strings.
+
+    Usage::
+
+        >>> import bluevia
+        >>> receiver = bluevia.NotificationReceiver(workers=4)
+        >>> server = bluevia.NotificationServer(receiver, ('', 8443), certfile='cert.pem', keyfile='key.pem')
+        >>> server.start()
+        >>> for kind, notification in receiver.events():
+        ...     print kind, notification
+        delivery_status {u'status': u'delivered', u'id': u'97286813874922402286', u'address': u'34600000000'}
+
+    """
+
+    def __init__(self, workers=4, queue_size=10000, paths=None, records=False, spool_threshold=None):
+        self.paths = paths or {}
+        self.records = records
+        self.spool_threshold = spool_threshold
+        self._received = Queue.Queue(queue_size)
+        #: Queue of parsed notifications, as (kind, notification) tuples (see :meth:`events`).
+        self.queue = Queue.Queue(queue_size)
+        #: Number of notifications accepted, rejected because the queues were full, and failed to be parsed,
+        #: as a dictionary with *accepted*, *rejected* and *failed* keys.
+        self.stats = {'accepted': 0, 'rejected': 0, 'failed': 0}
+        self._stats_lock = threading.Lock()
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name='bluevia-notifications-{0}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def submit(self, path, content_type, content):
+
+        """Accept a notification received at a path, to be parsed by the workers.
+
+        This is the entry point used by the WSGI app and by :class:`NotificationServer`, so it can also be
+        used to plug the receiver into other servers.
+
+        :returns: The HTTP status (as an ``int``) BlueVia must be answered with.
+
+        """
+
+        kind = self.paths.get(path) or _guess_kind(content_type or '', content)
+        if kind is None:
+            log.warning("Unsupported Content-Type '{0}' in notification to {1}".format(content_type, path))
+            return 415
+        try:
+            self._received.put_nowait((kind, content_type, content))
+        except Queue.Full:
+            self._count('rejected')
+            return 503
+        self._count('accepted')
+        return 200
+
+    def _work(self):
+        while True:
+            item = self._received.get()
+            if item is None:
+                return
+            kind, content_type, content = item
+            try:
+                notification = parse_notification(content_type, content, kind, self.records,
+                                                  self.spool_threshold)[1]
+            except (BVException, ValueError) as e:
+                log.warning('Bad {0} notification: {1}'.format(kind, e))
+                self._count('failed')
+                notification = e
+            except Exception as e:
+                # Whatever the notification is, the worker must keep parsing the next ones
+                log.exception('Unexpected error parsing {0} notification'.format(kind))
+                self._count('failed')
+                notification = e
+            # Blocking here makes notifications wait to be parsed, eventually rejecting new ones
+            self.queue.put((kind, notification))
+
+    def events(self, timeout=None):
+
+        """Yield the parsed notifications as (kind, notification) tuples, in the order they are parsed.
+
+        *kind* is ``'delivery_status'``, ``'sms'`` or ``'mms'`` and *notification* is what
+        :meth:`Api.parse_delivery_status`, :meth:`Api.parse_incoming_sms` or :meth:`Api.parse_incoming_mms`
+        returns, respectively (or the exception they raised, if the notification could not be parsed).
+
+        :param timeout: (optional) seconds to wait for a notification before finishing the iteration.
+            By default, it waits forever.
+
+        """
+
+        while True:
+            try:
+                yield self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                return
+
+    def close(self):
+
+        """Stop the workers once the notifications already received are parsed. """
+
+        for worker in self._workers:
+            self._received.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] != 'POST':
+            start_response('405 Method Not Allowed', [('Allow', 'POST'), ('Content-Length', '0')])
+            return []
+        try:
+            content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        content = environ['wsgi.input'].read(content_length)
+
+        status = self.submit(environ.get('PATH_INFO') or '/', environ.get('CONTENT_TYPE'), content)
+        headers = [('Content-Length', '0')]
+        if status == 503:
+            headers.append(('Retry-After', '1'))
+        start_response(_STATUS_LINES[status], headers)
+        return []
+
+
+_STATUS_LINES = {200: '200 OK', 415: '415 Unsupported Media Type', 503: '503 Service Unavailable'}
+
+
+class _NotificationHandler(BaseHTTPRequestHandler):
+
+    # Keep connections alive, so BlueVia can send many notifications through the same one
+    protocol_version = 'HTTP/1.1'
+    # Send each response in a single segment, without waiting for the previous one to be acknowledged
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        content = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        status = self.server.receiver.submit(self.path.split('?', 1)[0], self.headers.get('Content-Type'),
+                                             content)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        log.debug('{0} - {1}'.format(self.address_string(), format % args))
+
+
+class NotificationServer(ThreadingMixIn, HTTPServer):
+
+    """Multithreaded HTTP(S) server which passes the notifications it receives to a
+    :class:`NotificationReceiver`.
+
+    Each connection is served by its own thread and kept alive, so BlueVia can send many notifications
+    concurrently without opening a connection for each one.
+
+    :param receiver: the :class:`NotificationReceiver`.
+    :param server_address: (optional) (host, port) tuple to listen to. Default is ``('', 8443)``.
+    :param certfile: (optional) file with the server certificate, to serve HTTPS.
+    :param keyfile: (optional) file with the private key of the server certificate.
+
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, receiver, server_address=('', 8443), certfile=None, keyfile=None):
+        HTTPServer.__init__(self, server_address, _NotificationHandler)
+        self.receiver = receiver
+        if certfile:
+            import ssl
+            self.socket = ssl.wrap_socket(self.socket, certfile=certfile, keyfile=keyfile, server_side=True)
+
+    def start(self):
+
+        """Serve requests in a background thread, until :meth:`shutdown` is called. """
+
+        thread = threading.Thread(target=self.serve_forever, name='bluevia-notification-server')
+        thread.daemon = True
+        thread.start()
+        return thread
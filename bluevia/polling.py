@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+"""
+bluevia.polling
+~~~~~~~~~~~~~~~
+
+This module implements helpers to poll BlueVia efficiently on behalf of many messages or apps.
+
+:copyright: (c) 2013 Telefonica Investigación y Desarrollo, S.A.U.
+:license: Apache 2.0, see LICENSE for more details.
+
+"""
+
+import logging
+import heapq
+import itertools
+import threading
+import time
+import Queue
+
+from .exceptions import BVException
+
+
+log = logging.getLogger(__name__)
+
+
+class _Scheduler(object):
+
+    """Base class for pollers: it runs the polls which are due on a pool of threads, never exceeding
+    a global rate of polls per second nor a maximum number of polls in flight.
+
+    Subclasses implement :meth:`_poll`, which runs in a worker thread, and :meth:`_process`, which runs in the
+    consumer's thread, decides when the next poll is due and returns the items to be yielded.
+
+    """
+
+    def __init__(self, concurrency, max_rate):
+        self.concurrency = concurrency
+        self.max_rate = max_rate
+        self._lock = threading.Lock()
+        self._heap = []
+        self._counter = itertools.count()
+        self._results = Queue.Queue()
+        self._stopped = False
+
+    def _schedule(self, due, key):
+        with self._lock:
+            if not self._stopped:
+                heapq.heappush(self._heap, (due, next(self._counter), key))
+
+    def stop(self):
+
+        """Stop polling. The iteration in progress (if any) finishes once the polls in flight are done. """
+
+        with self._lock:
+            self._stopped = True
+            del self._heap[:]
+        # Wake up the consumer in case it's waiting for the next poll to be due
+        self._results.put((None, None))
+
+    def _pending(self):
+        """ Return whether there are keys to be polled in the future. """
+        with self._lock:
+            return bool(self._heap)
+
+    def _poll(self, key):
+        raise NotImplementedError
+
+    def _process(self, key, result):
+        raise NotImplementedError
+
+    def _run(self):
+
+        """Yield the items returned by :meth:`_process` until there is nothing else to poll. """
+
+        import requests
+        from multiprocessing.pool import ThreadPool
+
+        results = self._results
+        pool = ThreadPool(self.concurrency)
+        in_flight = 0
+        next_slot = time.time()
+
+        def poll(key):
+            try:
+                return key, self._poll(key)
+            except (BVException, requests.RequestException) as e:
+                log.info('Polling {0} failed: {1}'.format(key, e))
+                return key, e
+            except Exception as e:
+                # Any other error must reach _process too, or the poll would never be accounted as finished
+                log.exception('Polling {0} failed unexpectedly'.format(key))
+                return key, e
+
+        try:
+            while in_flight or self._pending():
+                # Dispatch due polls while there are free workers and the rate allows it
+                now = time.time()
+                wait = None
+                while in_flight < self.concurrency:
+                    with self._lock:
+                        if not self._heap:
+                            break
+                        due = max(self._heap[0][0], next_slot)
+                        if due > now:
+                            wait = due - now
+                            break
+                        key = heapq.heappop(self._heap)[2]
+                    pool.apply_async(poll, (key,), callback=results.put)
+                    in_flight += 1
+                    next_slot = max(next_slot, now) + (1.0 / self.max_rate if self.max_rate else 0)
+
+                if not in_flight and wait is None:
+                    continue
+
+                try:
+                    key, result = results.get(timeout=wait) if wait is not None else results.get()
+                except Queue.Empty:
+                    continue
+                if key is None:
+                    # Woken up by stop()
+                    continue
+                in_flight -= 1
+
+                for item in self._process(key, result):
+                    yield item
+        finally:
+            pool.terminate()
+
+
+class DeliveryTracker(_Scheduler):
+
+    """Track the delivery status of many sent SMS and MMS.
+
+    The delivery status of each tracked message is polled concurrently following its own exponential schedule
+    (the interval between polls grows from *initial_interval* to *max_interval*), and the message stops being
+    tracked as soon as it reaches a terminal status. The global poll rate never exceeds *max_rate*.
+
+    :param api: the :class:`Api` object used to poll the delivery status (it needs an *access token*).
+    :param callback: (optional) a function called with the message id and the new delivery status (as returned
+        by :meth:`Api.get_sms_delivery_status`) each time the delivery status of a message changes.
+    :param max_rate: (optional) maximum number of polls per second. Default is 10.
+    :param concurrency: (optional) maximum number of polls in flight. It defaults to the size of the
+        connection pool.
+    :param initial_interval: (optional) seconds between a message is tracked and its first poll. Default is 1.
+    :param max_interval: (optional) maximum number of seconds between polls of a message. Default is 300.
+    :param backoff: (optional) factor by which the interval between polls of a message grows. Default is 2.
+    :param expire_after: (optional) seconds after which a message which has not reached a terminal status
+        stops being tracked. By default messages are tracked until they reach a terminal status.
+    :param terminal_statuses: (optional) delivery statuses after which a message stops being tracked. It
+        defaults to :attr:`TERMINAL_STATUSES`.
+
+    Usage::
+
+        >>> import bluevia
+        >>> bluevia_client = bluevia.Api(CLIENT_ID, CLIENT_SECRET, ACCESS_TOKEN)
+        >>> tracker = bluevia.DeliveryTracker(bluevia_client, max_rate=5)
+        >>> for index, sms_id in bluevia_client.send_sms_batch(messages):
+        ...     tracker.add(sms_id)
+        >>> for sms_id, delivery_status in tracker.changes():
+        ...     print sms_id, delivery_status
+        97286813874922402286 {u'status': u'delivered', u'address': u'34600000000'}
+
+    """
+
+    #: Delivery statuses after which a message stops being tracked (by default).
+    TERMINAL_STATUSES = ('delivered', 'delivery_impossible', 'delivery_notification_not_supported',
+                         'delivery_failed', 'expired')
+
+    def __init__(self, api, callback=None, max_rate=10, concurrency=None, initial_interval=1, max_interval=300,
+                 backoff=2, expire_after=None, terminal_statuses=None):
+        _Scheduler.__init__(self, concurrency or api._pool_size(), max_rate)
+        self.api = api
+        self.callback = callback
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.expire_after = expire_after
+        self.terminal_statuses = terminal_statuses or self.TERMINAL_STATUSES
+        # Tracked messages: {msg_id: [kind, interval, last status, tracking start time]}
+        self._tracked = {}
+
+    def __len__(self):
+        return len(self._tracked)
+
+    def add(self, msg_id, kind='sms'):
+
+        """Start tracking the delivery status of a sent message.
+
+        :param msg_id: the id returned by :meth:`Api.send_sms` or :meth:`Api.send_mms`.
+        :param kind: (optional) ``'sms'`` (the default) or ``'mms'``.
+
+        """
+
+        if kind not in ('sms', 'mms'):
+            raise ValueError("'kind' must be 'sms' or 'mms'")
+
+        now = time.time()
+        with self._lock:
+            if msg_id in self._tracked:
+                return
+            self._tracked[msg_id] = [kind, self.initial_interval, None, now]
+        self._schedule(now + self.initial_interval, msg_id)
+
+    def _poll(self, msg_id):
+        if self._tracked[msg_id][0] == 'sms':
+            return self.api.get_sms_delivery_status(msg_id)
+        else:
+            return self.api.get_mms_delivery_status(msg_id)
+
+    def _process(self, msg_id, delivery_status):
+        entry = self._tracked[msg_id]
+        changed = not isinstance(delivery_status, Exception) and delivery_status != entry[2]
+        if changed:
+            entry[2] = delivery_status
+            if self.callback:
+                self.callback(msg_id, delivery_status)
+
+        now = time.time()
+        if changed and delivery_status.get('status') in self.terminal_statuses:
+            log.info('Message {0} reached terminal status {1}'.format(msg_id, delivery_status['status']))
+            with self._lock:
+                del self._tracked[msg_id]
+        elif self.expire_after is not None and now - entry[3] > self.expire_after:
+            log.info('Message {0} expired without reaching a terminal status'.format(msg_id))
+            with self._lock:
+                del self._tracked[msg_id]
+        else:
+            entry[1] = min(entry[1] * self.backoff, self.max_interval)
+            self._schedule(now + entry[1], msg_id)
+
+        return [(msg_id, delivery_status)] if changed else []
+
+    def changes(self):
+
+        """Poll the tracked messages and yield (message id, delivery status) tuples each time the delivery
+        status of a message changes, until no message is being tracked.
+
+        """
+
+        return self._run()
+
+    def run(self):
+
+        """Poll the tracked messages until none of them is being tracked, calling *callback* on each change. """
+
+        for change in self.changes():
+            pass
+
+
+class InboundPoller(_Scheduler):
+
+    """Poll incoming SMS and/or MMS of many apps, merging them into a single stream.
+
+    Each app (i.e. each :class:`Api` object, with its own credentials) is polled concurrently with the rest,
+    sharing the same connection pool and a global rate of polls per second. The interval between polls of each
+    app adapts to its traffic: it is reset to *min_interval* when messages are received, and it grows up to
+    *max_interval* while its inbox is empty. Failed polls (e.g. due to revoked credentials) are yielded too,
+    so a broken app does not just go silent.
+
+    :param apis: a list of :class:`Api` objects, one per app to be polled.
+    :param kinds: (optional) what is polled for each app: ``'sms'`` (the default), ``'mms'`` or both
+        (``('sms', 'mms')``).
+    :param max_rate: (optional) maximum number of polls per second. Default is 10.
+    :param concurrency: (optional) maximum number of polls in flight. It defaults to the size of the
+        connection pool.
+    :param min_interval: (optional) minimum number of seconds between polls of an app. Default is 1.
+    :param max_interval: (optional) maximum number of seconds between polls of an app. Default is 60.
+    :param backoff: (optional) factor by which the interval between polls of an app grows while its inbox is
+        empty. Default is 2.
+
+    Usage::
+
+        >>> import bluevia
+        >>> apis = [bluevia.Api(client_id, client_secret) for (client_id, client_secret) in credentials]
+        >>> poller = bluevia.InboundPoller(apis, kinds=('sms', 'mms'))
+        >>> for api, kind, message in poller.messages():
+        ...     if isinstance(message, Exception):
+        ...         print 'Polling', api.client_id, 'failed:', message
+        ...     else:
+        ...         print api.client_id, kind, message
+
+    """
+
+    def __init__(self, apis, kinds=('sms',), max_rate=10, concurrency=None, min_interval=1, max_interval=60,
+                 backoff=2):
+        if isinstance(kinds, basestring):
+            kinds = (kinds,)
+        if not set(kinds) <= set(('sms', 'mms')):
+            raise ValueError("'kinds' must contain 'sms' and/or 'mms'")
+        _Scheduler.__init__(self, concurrency or (apis[0]._pool_size() if apis else 1), max_rate)
+        self.apis = list(apis)
+        self.kinds = tuple(kinds)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        # Current interval of each (app index, kind) key
+        self._intervals = {}
+
+    def _poll(self, key):
+        index, kind = key
+        api = self.apis[index]
+        if kind == 'sms':
+            return api.get_incoming_sms()
+
+        import requests
+
+        # The MMS ids have already been dequeued from BlueVia, so a failing MMS must not lose the rest of them
+        messages = []
+        for mms_id in api.get_incoming_mms():
+            try:
+                messages.append(api.get_incoming_mms_details(mms_id))
+            except (BVException, requests.RequestException) as e:
+                log.info('Getting MMS {0} failed: {1}'.format(mms_id, e))
+                messages.append(e)
+            except Exception as e:
+                log.exception('Getting MMS {0} failed unexpectedly'.format(mms_id))
+                messages.append(e)
+        return messages
+
+    def _process(self, key, messages):
+        if messages and not isinstance(messages, Exception):
+            interval = self.min_interval
+        else:
+            interval = min(self._intervals[key] * self.backoff, self.max_interval)
+        self._intervals[key] = interval
+        self._schedule(time.time() + interval, key)
+
+        api, kind = self.apis[key[0]], key[1]
+        if isinstance(messages, Exception):
+            return [(api, kind, messages)]
+        return [(api, kind, message) for message in messages]
+
+    def messages(self):
+
+        """Poll the apps and yield (api, kind, message) tuples, until :meth:`stop` is called.
+
+        *api* is the :class:`Api` object of the app which received the message, and *kind* is ``'sms'`` or
+        ``'mms'``. *message* is an element of the list returned by :meth:`Api.get_incoming_sms` for SMS, or the
+        content of the MMS (as returned by :meth:`Api.get_incoming_mms_details`) for MMS. If polling an app
+        fails (or getting the content of one of its MMS does), *message* is the exception raised, and the app
+        keeps being polled (backing off as if its inbox were empty).
+
+        """
+
+        now = time.time()
+        for index in range(len(self.apis)):
+            for kind in self.kinds:
+                self._intervals[(index, kind)] = self.min_interval
+                self._schedule(now, (index, kind))
+
+        return self._run()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+bluevia.recipients
+~~~~~~~~~~~~~~~~~~
+
+This module implements the normalization, validation and de-duplication of the recipients of SMS and MMS,
+so malformed ones are rejected locally instead of costing a request to BlueVia.
+
+:copyright: (c) 2013 Telefonica Investigación y Desarrollo, S.A.U.
+:license: Apache 2.0, see LICENSE for more details.
+
+"""
+
+import re
+
+
+#: Minimum and maximum number of digits (country code included) of a phone number, as defined by E.164.
+MSISDN_MIN_LENGTH = 7
+MSISDN_MAX_LENGTH = 15
+
+# Characters used to make phone numbers readable (e.g. '+34 600-00.00.00'), which are removed
+_SEPARATORS = re.compile(r'[\s()./-]+')
+_MSISDN = re.compile(r'[1-9][0-9]{{{0},{1}}}\Z'.format(MSISDN_MIN_LENGTH - 1, MSISDN_MAX_LENGTH - 1))
+_WHITESPACE = re.compile(r'\s')
+
+
+def to_address(recipient):
+
+    """Return the BlueVia address of a recipient: ``'tel:+<digits>'`` if it's a phone number, or
+    ``'alias:<alias>'`` if it's an obfuscated identity. Addresses (e.g. normalized by :class:`RecipientList`)
+    are returned as they are.
+
+    """
+
+    if recipient.startswith(('tel:+', 'alias:')):
+        return recipient
+    # If the recipient contains only digits, it's an MSISDN, else it's an obfuscated identity
+    return 'tel:+' + recipient if recipient.isdigit() else 'alias:' + recipient
+
+
+def normalize_recipient(recipient):
+
+    """Return the BlueVia address (see :func:`to_address`) of a recipient written in any usual format.
+
+    Phone numbers must include the country code, and may be prefixed by ``+``, ``00`` or ``tel:``, and
+    contain spaces, dots, dashes, slashes or parentheses (e.g. ``'+34 600 00 00 00'``). Anything else not
+    containing whitespace is taken as an obfuscated identity (which may be prefixed by ``alias:``).
+
+    :param recipient: the phone number (or obfuscated identity), as a string or an integer.
+    :raises: :exc:`ValueError` if the recipient is malformed, or :exc:`TypeError` if it's neither a string
+        nor an integer.
+
+    Usage::
+
+        >>> import bluevia
+        >>> bluevia.normalize_recipient('+34 600-00.00.00')
+        'tel:+34600000000'
+
+    """
+
+    if isinstance(recipient, (int, long)) and not isinstance(recipient, bool):
+        recipient = str(recipient)
+    elif not isinstance(recipient, basestring):
+        raise TypeError('Recipients must be strings, not {0}'.format(type(recipient).__name__))
+
+    recipient = recipient.strip()
+    if recipient.startswith('alias:'):
+        alias = recipient[6:]
+    else:
+        number = recipient[4:] if recipient.startswith('tel:') else recipient
+        number = _SEPARATORS.sub('', number)
+        if number.startswith('+'):
+            number = number[1:]
+        elif number.startswith('00'):
+            number = number[2:]
+        if number.isdigit():
+            if not _MSISDN.match(number):
+                raise ValueError('Invalid phone number: {0!r}'.format(recipient))
+            return 'tel:+' + str(number)
+        if recipient.startswith(('tel:', '+')):
+            raise ValueError('Invalid phone number: {0!r}'.format(recipient))
+        alias = recipient
+
+    if not alias or _WHITESPACE.search(alias):
+        raise ValueError('Invalid obfuscated identity: {0!r}'.format(recipient))
+    return 'alias:' + alias
+
+
+class RecipientList(object):
+
+    """A list of recipients normalized (see :func:`normalize_recipient`), validated and de-duplicated in a
+    single pass, before anything is sent.
+
+    Iterating over it yields the addresses of the valid recipients, without duplicates, in the same order as
+    they were given. It can be passed as the *recipients* of :meth:`Api.broadcast_sms` and
+    :meth:`Api.broadcast_mms`, whose results' indexes are positions in :attr:`addresses`.
+
+    :param recipients: an iterable of phone numbers (or obfuscated identities).
+
+    Usage::
+
+        >>> import bluevia
+        >>> recipients = bluevia.RecipientList(['34600000000', '+34 600 000 000', '34 6OO', 'ABCDEF01'])
+        >>> recipients.addresses
+        ['tel:+34600000000', 'alias:ABCDEF01']
+        >>> recipients.rejected
+        [(2, '34 6OO', "Invalid obfuscated identity: '34 6OO'")]
+        >>> recipients.duplicates
+        [(1, '+34 600 000 000')]
+
+    """
+
+    def __init__(self, recipients):
+        #: the addresses of the valid recipients, without duplicates.
+        self.addresses = []
+        #: the position in the given recipients of each address in :attr:`addresses`.
+        self.positions = []
+        #: the malformed recipients, as (position, recipient, reason) tuples.
+        self.rejected = []
+        #: the recipients dropped because an earlier one has the same address, as (position, recipient) tuples.
+        self.duplicates = []
+
+        seen = set()
+        for position, recipient in enumerate(recipients):
+            try:
+                address = normalize_recipient(recipient)
+            except (ValueError, TypeError) as e:
+                self.rejected.append((position, recipient, str(e)))
+                continue
+            if address in seen:
+                self.duplicates.append((position, recipient))
+                continue
+            seen.add(address)
+            self.addresses.append(address)
+            self.positions.append(position)
+
+    def __iter__(self):
+        return iter(self.addresses)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __repr__(self):
+        return '<RecipientList: {0} recipients, {1} rejected, {2} duplicates>'.format(
+            len(self.addresses), len(self.rejected), len(self.duplicates))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+bluevia.records
+~~~~~~~~~~~~~~~
+
+This module implements lightweight record types, which can be returned instead of dictionaries
+to reduce the memory needed to keep lots of messages and delivery statuses.
+
+:copyright: (c) 2013 Telefonica Investigación y Desarrollo, S.A.U.
+:license: Apache 2.0, see LICENSE for more details.
+
+"""
+
+import collections
+
+
+class _Record(object):
+
+    """Base class for records: objects with a fixed set of fields, stored in slots instead of a dictionary,
+    which can be read as the dictionaries returned by default (e.g. ``sms['from']`` or ``sms.get('id')``).
+
+    Fields are also available as attributes (``from`` being available as ``from_``, since it is a reserved
+    word). Fields not included in the source dictionary are missing, as they would be in the dictionary,
+    and keys not defined by the record are discarded.
+
+    """
+
+    __slots__ = ()
+
+    #: Keys of the record, in the same order as their slots.
+    _keys = ()
+
+    def __init__(self, fields):
+        for key, slot in zip(self._keys, self.__slots__):
+            if key in fields:
+                setattr(self, slot, fields[key])
+
+    def _items(self):
+        for key, slot in zip(self._keys, self.__slots__):
+            try:
+                yield key, getattr(self, slot)
+            except AttributeError:
+                pass
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        try:
+            return getattr(self, 'from_' if key == 'from' else key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return (key for key, value in self._items())
+
+    def __len__(self):
+        return sum(1 for item in self._items())
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return (value for key, value in self._items())
+
+    def iteritems(self):
+        return self._items()
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self._items())
+
+    def to_dict(self):
+        """ Return the record as a dictionary (e.g. to serialize it as JSON). """
+        return dict(self._items())
+
+    def __eq__(self, other):
+        if isinstance(other, collections.Mapping):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, self.to_dict())
+
+
+class IncomingSms(_Record):
+
+    """An incoming SMS, with the keys described in :meth:`Api.get_incoming_sms`. """
+
+    __slots__ = ('id', 'from_', 'obfuscated', 'to', 'message', 'timestamp')
+    _keys = (u'id', u'from', u'obfuscated', u'to', u'message', u'timestamp')
+
+
+class IncomingMms(_Record):
+
+    """An incoming MMS, with the keys described in :meth:`Api.get_incoming_mms_details`. """
+
+    __slots__ = ('id', 'from_', 'obfuscated', 'to', 'subject', 'timestamp', 'attachments')
+    _keys = (u'id', u'from', u'obfuscated', u'to', u'subject', u'timestamp', u'attachments')
+
+
+class DeliveryStatus(_Record):
+
+    """The delivery status of a sent SMS or MMS, with the keys described in :meth:`Api.get_sms_delivery_status`
+    (and *id*, when it comes from a notification).
+
+    """
+
+    __slots__ = ('id', 'address', 'status')
+    _keys = (u'id', u'address', u'status')
+
+
+# Records are read-only mappings, although they don't inherit from Mapping so they have no instance dictionary
+collections.Mapping.register(_Record)
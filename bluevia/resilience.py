@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+"""
+bluevia.resilience
+~~~~~~~~~~~~~~~~~~
+
+This module implements the policies applied by pyBlueVia to requests when BlueVia fails or throttles them.
+
+:copyright: (c) 2013 Telefonica Investigación y Desarrollo, S.A.U.
+:license: Apache 2.0, see LICENSE for more details.
+
+"""
+
+import logging
+import collections
+import errno
+import os
+import random
+import re
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    # Not a POSIX system: buckets cannot be shared among processes
+    fcntl = None
+
+from .exceptions import CircuitOpenError
+
+
+log = logging.getLogger(__name__)
+
+
+class RetryPolicy(object):
+
+    """Policy to retry requests failed due to network errors or to transient BlueVia errors.
+
+    Failed requests are retried after an exponential backoff with random jitter, unless the response includes
+    a *Retry-After* header, which is honoured.
+
+    By default, only GET requests (which are idempotent) are retried. POST requests (e.g. sending an SMS) are
+    only retried when it is known that BlueVia has not processed them: the connection could not be established
+    or BlueVia rejected the request asking to retry later (429 or 503 with a *Retry-After* header).
+
+    :param attempts: (optional) maximum number of attempts (including the first one). Default is 3.
+    :param backoff: (optional) base backoff in seconds; the n-th retry waits a random time between 0 and
+        ``backoff * 2 ** (n - 1)`` seconds. Default is 0.5.
+    :param max_backoff: (optional) maximum number of seconds to wait before a retry. Requests whose
+        *Retry-After* is longer than this are not retried. Default is 30.
+    :param statuses: (optional) HTTP status codes which cause a retry. Default is 429, 500, 502, 503 and 504.
+    :param retry_posts: (optional) if ``True``, POST requests are retried as GET ones, even if that might
+        result in duplicated messages. Default is ``False``.
+
+    """
+
+    def __init__(self, attempts=3, backoff=0.5, max_backoff=30, statuses=(429, 500, 502, 503, 504),
+                 retry_posts=False):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = statuses
+        self.retry_posts = retry_posts
+
+    def get_delay(self, method, retries, resp=None, error=None):
+
+        """Return the number of seconds to wait before retrying a request, or ``None`` if it must not be retried.
+
+        :param method: the HTTP method of the request.
+        :param retries: number of times the request has already been retried.
+        :param resp: the response received, if any.
+        :param error: the exception raised when making the request, if any.
+
+        """
+
+        if retries + 1 >= self.attempts:
+            return None
+
+        retry_after = None
+        if resp is not None:
+            if resp.status_code not in self.statuses:
+                return None
+            retry_after = _retry_after(resp)
+            # BlueVia has not processed a request it asks to retry later
+            not_processed = retry_after is not None and resp.status_code in (429, 503)
+        else:
+            import requests
+            if not isinstance(error, (requests.ConnectionError, requests.Timeout)):
+                return None
+            not_processed = _not_sent(error)
+
+        if method != 'GET' and not self.retry_posts and not not_processed:
+            return None
+
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_backoff else None
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retries))
+
+
+class RateLimiter(object):
+
+    """Client-side rate limiter, which makes requests wait so BlueVia quotas are not exceeded.
+
+    It implements a token bucket per app and endpoint (i.e. per *client id* and API, such as ``smsoutbound``
+    or ``mmsoutbound``), refilled at *rate* tokens per second up to *burst* tokens. Each request takes a token,
+    and if there is none available it waits (instead of failing) until its turn comes.
+
+    Buckets are shared among all the threads of a process. If *path* is provided, buckets are stored in files
+    inside that directory, so they are also shared among all the processes in the same host using that path.
+
+    :param rate: maximum number of requests per second.
+    :param burst: (optional) maximum number of requests that can be made at once after a period of inactivity.
+        Default is *rate* (i.e. one second worth of requests).
+    :param path: (optional) directory where buckets are stored to share them among processes (POSIX only).
+    :param rates: (optional) a dictionary with the rate for specific endpoints (e.g. ``{'smsoutbound': 5}``),
+        which overrides *rate* for them.
+
+    """
+
+    def __init__(self, rate, burst=None, path=None, rates=None):
+        if path and not fcntl:
+            raise ValueError('Buckets cannot be shared among processes in this platform')
+        self.rate = rate
+        self.burst = burst
+        self.path = path
+        self.rates = rates or {}
+        self._lock = threading.Lock()
+        # In-process buckets: {key: [tokens, timestamp]}
+        self._buckets = {}
+
+    def acquire(self, client_id, endpoint):
+
+        """Take a token from the bucket of an app and endpoint, waiting until it's available.
+
+        :returns: The number of seconds waited.
+
+        """
+
+        rate = self.rates.get(endpoint, self.rate)
+        burst = self.burst or rate
+
+        with self._lock:
+            if self.path:
+                wait = self._take_from_file(client_id + '-' + endpoint, rate, burst)
+            else:
+                bucket = self._buckets.setdefault((client_id, endpoint), [burst, time.time()])
+                bucket[:] = self._take(bucket[0], bucket[1], rate, burst)
+                wait = max(0, -bucket[0] / rate)
+
+        if wait > 0:
+            log.debug('Rate limit reached for {0} {1}, waiting {2:.3f}s'.format(client_id, endpoint, wait))
+            time.sleep(wait)
+        return wait
+
+    @staticmethod
+    def _take(tokens, timestamp, rate, burst):
+        # Refill the bucket and take a token. When no token is available the bucket goes negative, which
+        # reserves the next token to be refilled, so waiting requests are served in order.
+        now = time.time()
+        tokens = min(burst, tokens + (now - timestamp) * rate) - 1
+        return [tokens, now]
+
+    def _take_from_file(self, key, rate, burst):
+        filename = os.path.join(self.path, 'bluevia-' + re.sub(r'[^\w.-]', '_', key) + '.bucket')
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            content = os.read(fd, 64).split()
+            try:
+                tokens, timestamp = float(content[0]), float(content[1])
+            except (IndexError, ValueError):
+                tokens, timestamp = burst, time.time()
+            tokens, timestamp = self._take(tokens, timestamp, rate, burst)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, '{0!r} {1!r}'.format(tokens, timestamp))
+        finally:
+            os.close(fd)
+        return max(0, -tokens / rate)
+
+
+class CircuitBreaker(object):
+
+    """Circuit breaker which makes requests to a failing BlueVia endpoint fail fast.
+
+    There is a circuit per endpoint (i.e. per host and API, such as ``smsoutbound``), which can be:
+
+    * *closed*: requests are made, and their outcome is recorded. A request fails if it raises a network error,
+      if BlueVia returns a 5xx HTTP status code or if it takes longer than *slow_call_duration* seconds. When
+      the failure rate of the last *window* requests reaches *failure_rate*, the circuit is opened.
+    * *open*: requests are not made, raising a :exc:`CircuitOpenError` instead. After *open_timeout* seconds,
+      the circuit becomes half-open.
+    * *half-open*: up to *half_open_calls* trial requests are made. Once all of them have succeeded the circuit
+      is closed again; as soon as one fails it is opened again.
+
+    :param failure_rate: (optional) failure rate (between 0 and 1) which opens the circuit. Default is 0.5.
+    :param window: (optional) number of recent requests on which the failure rate is computed. Default is 20.
+    :param min_calls: (optional) minimum number of recorded requests needed to open the circuit. Default is 10.
+    :param slow_call_duration: (optional) seconds after which a successful request is counted as failed.
+        By default, latency is not taken into account.
+    :param open_timeout: (optional) seconds an open circuit waits before becoming half-open. Default is 30.
+    :param half_open_calls: (optional) number of trial requests made while half-open. Default is 1.
+
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_rate=0.5, window=20, min_calls=10, slow_call_duration=None, open_timeout=30,
+                 half_open_calls=1):
+        self.failure_rate = failure_rate
+        self.window = window
+        self.min_calls = min_calls
+        self.slow_call_duration = slow_call_duration
+        self.open_timeout = open_timeout
+        self.half_open_calls = half_open_calls
+        self._lock = threading.Lock()
+        # Circuits: {endpoint: {'state', 'outcomes', 'opened_at', 'trials', 'successes'}}, where trials are the
+        # trial requests in flight and successes the ones that succeeded since the circuit became half-open
+        self._circuits = {}
+
+    def _circuit(self, endpoint):
+        if endpoint not in self._circuits:
+            self._circuits[endpoint] = {'state': self.CLOSED,
+                                        'outcomes': collections.deque(maxlen=self.window),
+                                        'opened_at': None,
+                                        'trials': 0,
+                                        'successes': 0}
+        return self._circuits[endpoint]
+
+    def before_call(self, endpoint):
+
+        """Check whether a request to an endpoint can be made, raising :exc:`CircuitOpenError` if not.
+
+        :returns: ``True`` if the request is a trial request of a half-open circuit, ``False`` otherwise. It must
+            be passed to :meth:`record` once the request is done, whatever its outcome.
+
+        """
+
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit['state'] == self.OPEN:
+                retry_in = circuit['opened_at'] + self.open_timeout - time.time()
+                if retry_in > 0:
+                    raise CircuitOpenError(endpoint, retry_in)
+                log.info('Circuit for {0} is half-open'.format(endpoint))
+                circuit['state'] = self.HALF_OPEN
+                circuit['trials'] = 0
+                circuit['successes'] = 0
+            if circuit['state'] == self.HALF_OPEN:
+                if circuit['trials'] + circuit['successes'] >= self.half_open_calls:
+                    raise CircuitOpenError(endpoint, 0)
+                circuit['trials'] += 1
+                return True
+            return False
+
+    def record(self, endpoint, success, duration, trial=False):
+
+        """Record the outcome of a request to an endpoint, which was allowed by :meth:`before_call`.
+
+        :param success: whether the request succeeded, or ``None`` if it failed for a reason unrelated to the
+            endpoint (e.g. a file attachment could not be read), so its outcome is not recorded.
+        :param duration: seconds the request took.
+        :param trial: (optional) what :meth:`before_call` returned for the request. The trial slot it took
+            is released.
+
+        """
+
+        if success and self.slow_call_duration is not None and duration > self.slow_call_duration:
+            success = False
+
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit['state'] == self.HALF_OPEN:
+                # Requests started before the circuit was opened do not count as trials
+                if not trial:
+                    return
+                circuit['trials'] -= 1
+                if success:
+                    circuit['successes'] += 1
+                    if circuit['successes'] >= self.half_open_calls:
+                        log.info('Circuit for {0} is closed'.format(endpoint))
+                        circuit['state'] = self.CLOSED
+                        circuit['outcomes'].clear()
+                elif success is not None:
+                    self._open(endpoint, circuit)
+            elif circuit['state'] == self.CLOSED and success is not None:
+                outcomes = circuit['outcomes']
+                outcomes.append(success)
+                if len(outcomes) >= self.min_calls and \
+                        float(outcomes.count(False)) / len(outcomes) >= self.failure_rate:
+                    self._open(endpoint, circuit)
+
+    def _open(self, endpoint, circuit):
+        log.warning('Circuit for {0} is open'.format(endpoint))
+        circuit['state'] = self.OPEN
+        circuit['opened_at'] = time.time()
+        circuit['outcomes'].clear()
+
+    def states(self):
+
+        """Return the state of every circuit, e.g. for health checks.
+
+        :returns: A dictionary with an entry per endpoint (as ``host/endpoint``), each of them being a dictionary
+            with the following keys:
+
+            * *state*: ``'closed'``, ``'open'`` or ``'half-open'``.
+            * *failure_rate*: failure rate of the recent requests (while closed).
+            * *calls*: number of recent requests the failure rate is computed on.
+
+        """
+
+        with self._lock:
+            states = {}
+            for endpoint, circuit in self._circuits.iteritems():
+                outcomes = circuit['outcomes']
+                states[endpoint] = {'state': circuit['state'],
+                                    'failure_rate': float(outcomes.count(False)) / len(outcomes) if outcomes else 0.0,
+                                    'calls': len(outcomes)}
+            return states
+
+
+def _retry_after(resp):
+
+    """Return the number of seconds in the Retry-After header of a response, or None if not present or invalid. """
+
+    value = resp.headers.get('retry-after')
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    from email.utils import parsedate_tz, mktime_tz
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time.time())
+
+
+def _not_sent(error):
+
+    """Return whether a request failed before being sent (so it can be safely retried). """
+
+    import requests
+    try:
+        from requests.packages.urllib3.exceptions import NewConnectionError
+    except ImportError:
+        # Old urllib3 versions report connection errors as socket errors
+        NewConnectionError = ()
+
+    if isinstance(error, getattr(requests.exceptions, 'ConnectTimeout', ())):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError) or getattr(reason, 'errno', None) == errno.ECONNREFUSED
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+bluevia.tokens
+~~~~~~~~~~~~~~
+
+This module implements the stores where *access tokens* are kept, so all the :class:`Api` objects (and
+processes) acting on behalf of the same user share them.
+
+:copyright: (c) 2013 Telefonica Investigación y Desarrollo, S.A.U.
+:license: Apache 2.0, see LICENSE for more details.
+
+"""
+
+import logging
+import os
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+class _Flight(object):
+
+    """ An acquisition of an access token in progress, which other threads wait for """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.access_token = None
+        self.error = None
+
+
+class TokenStore(object):
+
+    """Base class of the stores of *access tokens*, which are kept per app (*client id*) and user.
+
+    Subclasses must implement :meth:`get`, :meth:`set` and :meth:`delete`. :meth:`acquire` makes sure
+    concurrent acquisitions of the token of a user with the same *authorization code* result in a single token
+    exchange.
+
+    """
+
+    def __init__(self):
+        self._flights_lock = threading.Lock()
+        # Acquisitions in progress: {(client_id, user, key): _Flight}
+        self._flights = {}
+
+    def get(self, client_id, user=None):
+
+        """Return the *access token* of a user, or ``None`` if there is none stored. """
+
+        raise NotImplementedError
+
+    def set(self, client_id, user, access_token):
+
+        """Store the *access token* of a user, replacing the previous one. """
+
+        raise NotImplementedError
+
+    def delete(self, client_id, user=None):
+
+        """Remove the *access token* of a user (e.g. because it has been revoked). """
+
+        raise NotImplementedError
+
+    def acquire(self, client_id, user, fetch, key):
+
+        """Call *fetch* to get a new *access token* of a user, store it (replacing the previous one) and return it.
+
+        While *fetch* is running, other threads acquiring the token of the same user with the same *key* wait
+        for it and get its result (or the exception it raised), so a burst of calls results in a single token
+        exchange. Acquisitions with different keys (e.g. a re-authorization of the user) are never merged.
+
+        :param fetch: function getting an *access token* (e.g. exchanging an *authorization code*).
+        :param key: what *fetch* exchanges for the *access token* (e.g. the *authorization code*).
+
+        """
+
+        key = (client_id, user, key)
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            log.debug('Waiting for the access token of {0} being acquired by another thread'.format(key))
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.access_token
+
+        try:
+            flight.access_token = fetch()
+            self.set(client_id, user, flight.access_token)
+            return flight.access_token
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class MemoryTokenStore(TokenStore):
+
+    """Store of *access tokens* kept in memory, shared among all the threads of a process.
+
+    Usage::
+
+        >>> import bluevia
+        >>> tokens = bluevia.MemoryTokenStore()
+        >>> bluevia_client = bluevia.Api(CLIENT_ID, CLIENT_SECRET, token_store=tokens, user='alice')
+
+    """
+
+    def __init__(self):
+        super(MemoryTokenStore, self).__init__()
+        self._lock = threading.Lock()
+        self._tokens = {}
+
+    def get(self, client_id, user=None):
+        with self._lock:
+            return self._tokens.get((client_id, user))
+
+    def set(self, client_id, user, access_token):
+        with self._lock:
+            self._tokens[(client_id, user)] = access_token
+
+    def delete(self, client_id, user=None):
+        with self._lock:
+            self._tokens.pop((client_id, user), None)
+
+
+class SqliteTokenStore(TokenStore):
+
+    """Store of *access tokens* kept in an SQLite database file, shared among all the processes using it.
+
+    The token exchange is made without holding any lock on the database, so a slow *Authorization Server* does
+    not block other processes. Acquisitions are only coalesced among the threads of a process: if several
+    processes get a token for the same user at the same time, the last one stored is kept.
+
+    :param path: path of the database file. It is created if it does not exist.
+    :param timeout: (optional) seconds to wait for another process to release the database. Default is 60.
+
+    Usage::
+
+        >>> import bluevia
+        >>> tokens = bluevia.SqliteTokenStore('/var/lib/myapp/tokens.db')
+        >>> bluevia_client = bluevia.Api(CLIENT_ID, CLIENT_SECRET, token_store=tokens, user='alice')
+
+    """
+
+    def __init__(self, path, timeout=60):
+        super(SqliteTokenStore, self).__init__()
+        self.path = path
+        self.timeout = timeout
+        # A connection per thread, as SQLite connections cannot be shared among threads (nor processes)
+        self._local = threading.local()
+        self._connection().execute('CREATE TABLE IF NOT EXISTS access_tokens ('
+                                   'client_id TEXT NOT NULL, user TEXT NOT NULL, access_token TEXT NOT NULL, '
+                                   'PRIMARY KEY (client_id, user))')
+
+    def _connection(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            import sqlite3
+            # Each statement is committed on its own (isolation_level=None)
+            self._local.connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            # Tokens are returned as str, as they are used in HTTP headers
+            self._local.connection.text_factory = str
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, client_id, user=None):
+        row = self._connection().execute('SELECT access_token FROM access_tokens WHERE client_id = ? AND user = ?',
+                                         (client_id, user or '')).fetchone()
+        return row[0] if row else None
+
+    def set(self, client_id, user, access_token):
+        self._connection().execute('INSERT OR REPLACE INTO access_tokens (client_id, user, access_token) '
+                                   'VALUES (?, ?, ?)', (client_id, user or '', access_token))
+
+    def delete(self, client_id, user=None):
+        self._connection().execute('DELETE FROM access_tokens WHERE client_id = ? AND user = ?',
+                                   (client_id, user or ''))
@@ -9,28 +9,27 @@ This module contains a set of classes and functions internally used by pyBlueVia
 """
 
 import logging
-import json
 import re
-#import os.path
+import os
+import binascii
 from datetime import datetime
-from email.mime.multipart import MIMEMultipart
-from email.mime.nonmultipart import MIMENonMultipart
 import email
-import mimetypes
-
-from requests.auth import AuthBase
 
+from . import jsoncodec
 from .exceptions import ContentTypeError
 
 
 log = logging.getLogger(__name__)
 
 
-class OAuth2(AuthBase):
+class OAuth2(object):
 
     """This is a very very simple implementation of OAuth2 to attach an
     OAuth2 bearer token Authorization header to the given Request object.
 
+    Requests accepts any callable as authentication, so it does not extend ``requests.auth.AuthBase``
+    (and importing requests is delayed until a request is made).
+
     """
 
     def __init__(self, access_token):
@@ -41,79 +40,624 @@ class OAuth2(AuthBase):
         return r
 
 
+class MultipartEncoder(object):
+
+    """Streaming multipart/mixed body encoder.
+
+    It is a file-like object which generates the body chunk by chunk as it is read (or iterated), so
+    the whole body is never held in memory: file-like payloads are read in chunks of :attr:`chunk_size`
+    bytes only when their turn comes.
+
+    Each part is a tuple containing a list of (header, value) tuples and the payload, which can be a string,
+    a file-like object or a list of them (written one after the other).
+    Parts already encoded with the same boundary (see :func:`encode_parts`) can be appended to the parts as
+    a byte string, which is written as is.
+
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, parts, boundary=None, encoded_parts=None):
+        self.boundary = boundary or new_boundary()
+        self.content_type = 'multipart/mixed; boundary="' + self.boundary + '"'
+
+        # The body is a sequence of segments, each being a string or a file-like object
+        self._segments = []
+        for index, (headers, payload) in enumerate(parts):
+            self._segments.append(_part_header(self.boundary, headers, index == 0))
+            self._segments.extend(payload if isinstance(payload, list) else [payload])
+        if encoded_parts:
+            self._segments.append(encoded_parts)
+        self._segments.append('\r\n--' + self.boundary + '--\r\n')
+
+        #: Length in bytes of the whole body, or ``None`` if it cannot be known in advance.
+        self.len = 0
+        for segment in self._segments:
+            size = len(segment) if isinstance(segment, bytes) else _remaining_size(segment)
+            if size is None:
+                self.len = None
+                break
+            self.len += size
+
+        # Initial position of file-like segments, so the body can be read again
+        self._positions = []
+        for segment in self._segments:
+            if not isinstance(segment, bytes):
+                try:
+                    self._positions.append((segment, segment.tell()))
+                except (AttributeError, IOError, OSError, ValueError):
+                    self._positions.append((segment, None))
+
+        self._chunks = iter(self)
+        self._chunk = ''
+        self._offset = 0
+
+    def rewind(self):
+
+        """Go back to the beginning of the body, so it can be read again.
+
+        It returns ``False`` if that's not possible because some file-like payload cannot be seeked.
+
+        """
+
+        try:
+            for segment, position in self._positions:
+                if position is None:
+                    return False
+                segment.seek(position)
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+
+        self._chunks = iter(self)
+        self._chunk = ''
+        self._offset = 0
+        return True
+
+    def __len__(self):
+        if self.len is None:
+            raise TypeError('Body length is unknown')
+        return self.len
+
+    def __iter__(self):
+        for segment in self._segments:
+            if isinstance(segment, bytes):
+                yield segment
+            else:
+                while True:
+                    chunk = segment.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+    def read(self, size=-1):
+
+        """Read at most size bytes of the body (or the rest of the body if size is negative or omitted). """
+
+        if size is None or size < 0:
+            data = self._chunk[self._offset:] + ''.join(self._chunks)
+            self._chunk, self._offset = '', 0
+            return data
+
+        pieces = []
+        while size > 0:
+            if self._offset >= len(self._chunk):
+                self._chunk = next(self._chunks, '')
+                self._offset = 0
+                if not self._chunk:
+                    break
+            piece = self._chunk[self._offset:self._offset + size]
+            self._offset += len(piece)
+            size -= len(piece)
+            pieces.append(piece)
+
+        return ''.join(pieces)
+
+
+def new_boundary():
+
+    """ Return a random multipart boundary, as random as uuid.uuid4().hex (without importing uuid, which loads ctypes) """
+
+    return binascii.hexlify(os.urandom(16))
+
+
+def _header_value(value):
+
+    """Return a header value as a byte string: ASCII if possible, or else an RFC 2047 encoded-word. """
+
+    if not isinstance(value, unicode):
+        return value
+    try:
+        return value.encode('ascii')
+    except UnicodeEncodeError:
+        from email.header import Header
+        # A long enough line length so the value is not folded into several lines
+        return Header(value, 'utf-8', maxlinelen=len(value) * 12 + 20).encode()
+
+
+def _part_header(boundary, headers, first=False):
+    # Delimiter and headers of a part, always as a byte string (even if some header value is unicode)
+    return (('--' if first else '\r\n--') + _header_value(boundary) + '\r\n' +
+            ''.join(_header_value(name) + ': ' + _header_value(value) + '\r\n' for (name, value) in headers) +
+            '\r\n')
+
+
+def encode_parts(parts, boundary):
+
+    """Encode multipart parts (see :class:`MultipartEncoder`), which are not the first ones of the body, into a
+    byte string, reading the whole content of file-like payloads.
+
+    """
+
+    pieces = []
+    for headers, payload in parts:
+        # Headers are encoded to bytes, so unicode ones (e.g. u'image/gif') are not mixed with binary payloads
+        pieces.append(_part_header(boundary, headers))
+        for segment in payload if isinstance(payload, list) else [payload]:
+            for chunk in iter_chunks(segment):
+                if not isinstance(chunk, bytes):
+                    raise TypeError('Binary payloads must be byte strings (or file-like objects returning them)')
+                pieces.append(chunk)
+    return ''.join(pieces)
+
+
+def _remaining_size(fileobj):
+
+    """Return the number of bytes from the current position to the end of a file-like object,
+    or None if it cannot be known.
+
+    """
+
+    try:
+        return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+
+    try:
+        position = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell() - position
+        fileobj.seek(position)
+        return size
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+# Number of bytes needed by sniff_content_type() to recognise any format
+SNIFF_SIZE = 64
+
+
+def _riff_content_type(header):
+    # RIFF containers: the format is at bytes 8-12
+    return {'WAVE': 'audio/wav', 'AVI ': 'video/x-msvideo', 'WEBP': 'image/webp'}.get(header[8:12])
+
+
+def _ftyp_content_type(header):
+    # ISO base media (MP4, 3GP, QuickTime) files: the major brand is at bytes 8-12
+    if header[4:8] != 'ftyp':
+        return None
+    brand = header[8:12]
+    if brand.startswith('3gp'):
+        return 'video/3gpp'
+    if brand.startswith('3g2'):
+        return 'video/3gpp2'
+    return {'qt  ': 'video/quicktime', 'M4A ': 'audio/mp4', 'M4B ': 'audio/mp4'}.get(brand, 'video/mp4')
+
+
+def _ebml_content_type(header):
+    # Matroska and WebM files have the same header, but the doctype
+    return 'video/webm' if 'webm' in header else 'video/x-matroska'
+
+
+# Magic numbers of the image, audio and video formats supported by MMS: (prefix, Content-Type or function
+# finding it out from the header)
+_MAGIC_NUMBERS = [
+    ('\xff\xd8\xff', 'image/jpeg'),
+    ('\x89PNG\r\n\x1a\n', 'image/png'),
+    ('GIF87a', 'image/gif'),
+    ('GIF89a', 'image/gif'),
+    ('BM', 'image/bmp'),
+    ('II*\x00', 'image/tiff'),
+    ('MM\x00*', 'image/tiff'),
+    ('ID3', 'audio/mpeg'),
+    ('\xff\xfb', 'audio/mpeg'),
+    ('\xff\xf3', 'audio/mpeg'),
+    ('\xff\xf2', 'audio/mpeg'),
+    ('\xff\xf1', 'audio/aac'),
+    ('\xff\xf9', 'audio/aac'),
+    ('#!AMR\n', 'audio/amr'),
+    ('#!AMR-WB\n', 'audio/amr-wb'),
+    ('OggS', 'audio/ogg'),
+    ('fLaC', 'audio/flac'),
+    ('MThd', 'audio/midi'),
+    ('RIFF', _riff_content_type),
+    ('\x1aE\xdf\xa3', _ebml_content_type),
+    ('\x00\x00\x01\xba', 'video/mpeg'),
+    ('\x00\x00\x01\xb3', 'video/mpeg'),
+    ('0&\xb2u\x8ef\xcf\x11', 'video/x-ms-asf'),
+    ('FLV\x01', 'video/x-flv'),
+]
+
+# Magic numbers indexed by their first byte (longest first), so a header is only compared with a few of them.
+# ISO base media files are checked apart, as their magic number is not at the beginning.
+_MAGIC_INDEX = {}
+for _prefix, _content_type in sorted(_MAGIC_NUMBERS, key=lambda item: -len(item[0])):
+    _MAGIC_INDEX.setdefault(_prefix[0], []).append((_prefix, _content_type))
+del _prefix, _content_type
+
+# Fallback when the format is not recognised from the content
+_EXTENSION_CONTENT_TYPES = {
+    'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'jpe': 'image/jpeg', 'png': 'image/png', 'gif': 'image/gif',
+    'bmp': 'image/bmp', 'wbmp': 'image/vnd.wap.wbmp', 'tif': 'image/tiff', 'tiff': 'image/tiff',
+    'webp': 'image/webp', 'svg': 'image/svg+xml',
+    'mp3': 'audio/mpeg', 'aac': 'audio/aac', 'amr': 'audio/amr', 'awb': 'audio/amr-wb', 'ogg': 'audio/ogg',
+    'oga': 'audio/ogg', 'flac': 'audio/flac', 'mid': 'audio/midi', 'midi': 'audio/midi', 'wav': 'audio/wav',
+    'm4a': 'audio/mp4', 'm4b': 'audio/mp4',
+    '3gp': 'video/3gpp', '3g2': 'video/3gpp2', 'mp4': 'video/mp4', 'm4v': 'video/mp4', 'mov': 'video/quicktime',
+    'avi': 'video/x-msvideo', 'mpg': 'video/mpeg', 'mpeg': 'video/mpeg', 'webm': 'video/webm',
+    'mkv': 'video/x-matroska', 'asf': 'video/x-ms-asf', 'wmv': 'video/x-ms-wmv', 'flv': 'video/x-flv',
+}
+
+
+def sniff_content_type(header, name=None):
+
+    """Find out the Content-Type of an image, audio or video from its first bytes or, if the format is not
+    recognised, from the extension of its file name.
+
+    :param header: the first bytes (at least :data:`SNIFF_SIZE`, unless it is shorter) of the content.
+    :param name: (optional) the file name of the content.
+    :returns: The Content-Type, or ``None`` if it could not be found out.
+
+    """
+
+    if header:
+        for prefix, content_type in _MAGIC_INDEX.get(header[0], ()):
+            if header.startswith(prefix):
+                if not isinstance(content_type, str):
+                    content_type = content_type(header)
+                if content_type:
+                    return content_type
+        content_type = _ftyp_content_type(header)
+        if content_type:
+            return content_type
+
+    if name and '.' in name:
+        return _EXTENSION_CONTENT_TYPES.get(name.rsplit('.', 1)[1].lower())
+    return None
+
+
+def _peek(fileobj):
+
+    """Return the first bytes of a file-like object and the payload to send it: the object itself, positioned
+    where it was, or if it cannot be seeked, a list with the bytes already read and the object.
+
+    """
+
+    try:
+        position = fileobj.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        position = None
+    header = fileobj.read(SNIFF_SIZE)
+    if position is not None:
+        try:
+            fileobj.seek(position)
+            return header, fileobj
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+    return header, [header, fileobj]
+
+
+def _attachment_part(attachment, index):
+
+    """Return the headers and payload of the part of an attachment, checking it's supported. """
+
+    # Textual attachments
+    if isinstance(attachment, basestring):
+        if isinstance(attachment, unicode):
+            attachment = attachment.encode('utf-8')
+        return ([('Content-Type', 'text/plain; charset="utf-8"'),
+                 ('Content-Transfer-Encoding', '8bit')], attachment)
+
+    # Binary attachments (image, audio or video)
+    if hasattr(attachment, 'read'):
+        mimetype, payload = None, attachment
+    elif isinstance(attachment, (tuple, list)) and len(attachment) == 2:
+        mimetype, payload = attachment
+    else:
+        raise TypeError('Attachment #{0} must be a string, a file-like object or a '
+                        '(content type, content) tuple'.format(index))
+    # Checked here, as a unicode content would otherwise be taken as a file and fail while being sent
+    if not isinstance(payload, bytes) and not hasattr(payload, 'read'):
+        raise TypeError('The content of attachment #{0} must be a byte string or a file-like object'.format(index))
+    if not mimetype:
+        # Find it out from the content
+        if hasattr(payload, 'read'):
+            name = getattr(payload, 'name', None)
+            header, payload = _peek(payload)
+            mimetype = sniff_content_type(header, name if isinstance(name, basestring) else None)
+        else:
+            mimetype = sniff_content_type(payload[:SNIFF_SIZE])
+        if not mimetype:
+            raise ContentTypeError("Unknown Content-Type of attachment #{0} (pass it as a (content type, content) "
+                                   "tuple)".format(index))
+    if not '/' in mimetype:
+        error_str = "Invalid Content-Type '{0}' in attachment #{1}"
+        raise ContentTypeError(error_str.format(mimetype, index))
+    maintype, subtype = mimetype.split('/', 1)
+    if not maintype in ('image', 'audio', 'video'):
+        error_str = ("Unsupported Content-Type '{0}' in attachment #{1} "
+                     "(only image, audio or video are supported)")
+        raise ContentTypeError(error_str.format(mimetype, index))
+    return ([('Content-Type', mimetype),
+             ('Content-Transfer-Encoding', 'binary'),
+             ('Content-Disposition', 'attachment')], payload)
+
+
 def build_mms_body(metadata, attachments):
 
     """Build a MMS body based on metadata and attachments.
 
     MMS body is built as a multipart/mixed body whose first part is the metadata's JSON representation
-    and the other parts are the attachments.
+    and the other parts are the attachments. It is returned as a :class:`MultipartEncoder`, so attachments
+    are validated here but file-like attachments are not read until the body is sent (except their first
+    bytes, when their Content-Type is found out from them).
 
     """
 
-    body = MIMEMultipart(_subtype='mixed')
+    # Attachments of a template are already validated and encoded; the rest are validated before building anything
+    if isinstance(attachments, MmsTemplate):
+        attachment_parts = []
+    else:
+        attachment_parts = [_attachment_part(attachment, index) for index, attachment in enumerate(attachments)]
 
     # Add MMS metadata (root fields) as a json part
-    part = MIMENonMultipart(_maintype='application', _subtype='json')
-    part.add_header('Content-Transfer-Encoding', '8bit')
-    part.set_payload(payload=json.dumps(metadata, ensure_ascii=False))
-    del(part['MIME-Version'])
-    body.attach(part)
-
-    for attachment in attachments:
-        # Textual attachments
-        if isinstance(attachment, basestring):
-            part = MIMENonMultipart(_maintype='text', _subtype='plain')
-            part.add_header('Content-Transfer-Encoding', '8bit')
-            part.set_payload(payload=attachment, charset='utf-8')
-            del(part['MIME-Version'])
-            body.attach(part)
-
-        # Binary attachments (image, audio or video)
-        elif isinstance(attachment, (file, tuple, list)):
-            if isinstance(attachment, file):
-                mimetype = mimetypes.guess_type(attachment.name, strict=False)[0]
-                payload = attachment.read()
+    payload = jsoncodec.dumps(metadata)
+    parts = [([('Content-Type', 'application/json'),
+               ('Content-Transfer-Encoding', '8bit')], payload)]
+
+    if isinstance(attachments, MmsTemplate):
+        return MultipartEncoder(parts, attachments.boundary, attachments.encoded_parts)
+    return MultipartEncoder(parts + attachment_parts)
+
+
+class MmsTemplate(object):
+
+    """Attachments of an MMS validated and encoded once, to send the same MMS to many recipients.
+
+    The multipart body of an MMS consists of its metadata (which includes the recipient) and its attachments.
+    A template keeps the attachments already encoded, as an immutable string shared by the bodies of all the
+    MMS sent with it, so sending each of them only takes encoding its metadata. File-like attachments are
+    read (into memory) when the template is created.
+
+    It can be passed as the *attachments* of :meth:`Api.send_mms` and :meth:`Api.broadcast_mms`.
+
+    :param attachments: a list of attachments, as accepted by :meth:`Api.send_mms`.
+
+    Usage::
+
+        >>> import bluevia
+        >>> bluevia_client = bluevia.Api(CLIENT_ID, CLIENT_SECRET, ACCESS_TOKEN)
+        >>> template = bluevia.MmsTemplate(('Look at this picture', open('picture.gif', 'rb')))
+        >>> for to in recipients:
+        ...     bluevia_client.send_mms(to=to, subject='Hello world!', attachments=template)
+
+    """
+
+    def __init__(self, attachments):
+        parts = [_attachment_part(attachment, index) for index, attachment in enumerate(attachments)]
+        #: Boundary of the multipart bodies built with the template.
+        self.boundary = new_boundary()
+        #: The encoded attachments (delimiters and headers of their parts included), as a byte string.
+        self.encoded_parts = encode_parts(parts, self.boundary)
+
+
+def iter_chunks(body, content_length=None, chunk_size=65536):
+
+    """Yield the content of a body in chunks.
+
+    The body can be a string, a file-like object (read until EOF or until content_length bytes have been read)
+    or an iterable of strings (e.g. ``Response.iter_content()``).
+
+    """
+
+    if isinstance(body, basestring):
+        yield body.encode('utf-8') if isinstance(body, unicode) else body
+    elif hasattr(body, 'read'):
+        remaining = content_length
+        while remaining is None or remaining > 0:
+            chunk = body.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+    else:
+        for chunk in body:
+            yield chunk
+
+
+class _Spool(object):
+
+    """Sink where a part's payload is written while it's parsed.
+
+    The payload is kept in memory as a string unless it grows bigger than threshold bytes, in which case it's
+    moved to a temporary file.
+
+    """
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold
+        self.pieces = []
+        self.size = 0
+        self.file = None
+
+    def write(self, data):
+        if not data:
+            return
+        if self.file:
+            self.file.write(data)
+            return
+        self.pieces.append(data)
+        self.size += len(data)
+        if self.threshold is not None and self.size > self.threshold:
+            import tempfile
+            self.file = tempfile.TemporaryFile()
+            self.file.write(''.join(self.pieces))
+            self.pieces = None
+
+    def getvalue(self):
+        if self.file:
+            self.file.seek(0)
+            return self.file
+        return ''.join(self.pieces)
+
+
+class _Decoder(object):
+
+    """Incremental Content-Transfer-Encoding decoder writing the decoded payload into a sink. """
+
+    def __init__(self, encoding, sink):
+        self.encoding = (encoding or '').strip().lower()
+        self.sink = sink
+        self.pending = ''
+
+    def write(self, data):
+        if self.encoding == 'base64':
+            data = self.pending + ''.join(data.split())
+            usable = len(data) - len(data) % 4
+            self.pending = data[usable:]
+            self.sink.write(binascii.a2b_base64(data[:usable]))
+        elif self.encoding == 'quoted-printable':
+            # Only whole lines are decoded, so soft line breaks and escapes are never split
+            data = self.pending + data
+            usable = data.rfind('\n') + 1
+            self.pending = data[usable:]
+            self.sink.write(binascii.a2b_qp(data[:usable]))
+        else:
+            self.sink.write(data)
+
+    def close(self):
+        if self.pending:
+            if self.encoding == 'base64':
+                self.sink.write(binascii.a2b_base64(self.pending + '=' * (-len(self.pending) % 4)))
             else:
-                mimetype = attachment[0]
-                payload = attachment[1]
-            if not mimetype or not '/' in mimetype:
-                error_str = "Invalid Content-Type '{0}' in attachment #{1}"
-                raise ContentTypeError(error_str.format(mimetype, attachments.index(attachment)))
-            maintype, subtype = mimetype.split('/')
-            if not maintype in ('image', 'audio', 'video'):
-                error_str = ("Unsupported Content-Type '{0}' in attachment #{1} "
-                             "(only image, audio or video are supported)")
-                raise ContentTypeError(error_str.format(mimetype, attachments.index(attachment)))
-            part = MIMENonMultipart(_maintype=maintype, _subtype=subtype)
-            part.add_header('Content-Transfer-Encoding', 'binary')
-            part.add_header('Content-Disposition', 'attachment')  # , filename=os.path.basename(attachment.name))
-            part.set_payload(payload=payload)
-            del(part['MIME-Version'])
-            body.attach(part)
-
-    return body
-
-
-def parse_mms_body(content_type, body):
+                self.sink.write(binascii.a2b_qp(self.pending))
+            self.pending = ''
+        return self.sink.getvalue()
 
-    """Parse a MMS body passed as a multipart/mixed body and returns metadata and attachments.  """
 
-    mime_header = 'Content-Type: ' + content_type + '\n'\
-                  'MIME-Version: 1.0\n\n'
-    body = email.message_from_string(mime_header + body)
+def iter_multipart(content_type, body, content_length=None, spool_threshold=None):
 
-    if not body.is_multipart():
+    """Parse a multipart body incrementally, yielding a (content type, payload) tuple per part.
+
+    The body (see :func:`iter_chunks`) is read in chunks and each part is yielded as soon as it has been
+    completely read, so memory usage does not depend on the size of the whole body.
+    Payloads are decoded according to their Content-Transfer-Encoding. If spool_threshold is set, payloads
+    bigger than that number of bytes are returned as temporary files (positioned at their beginning) instead
+    of strings.
+
+    """
+
+    import cgi
+
+    value, params = cgi.parse_header(content_type)
+    if not value.lower().startswith('multipart/'):
         raise ContentTypeError('Non-multipart body')
+    if not params.get('boundary'):
+        raise ContentTypeError('Multipart body without boundary')
+
+    # Delimiters are searched as '\n--boundary', so the preceding '\r' (if any) must be removed from payloads.
+    # A '\n' is prepended to the body so the first delimiter can be found in the same way.
+    delimiter = '\n--' + params['boundary']
+    chunks = iter_chunks(body, content_length)
+    buf = '\n'
+    finished = False
+
+    def fill(buf):
+        for chunk in chunks:
+            return buf + chunk, True
+        return buf, False
+
+    # Skip the preamble
+    while True:
+        index = buf.find(delimiter)
+        if index >= 0:
+            buf = buf[index + len(delimiter):]
+            break
+        buf = buf[-len(delimiter):]
+        buf, more = fill(buf)
+        if not more:
+            raise ContentTypeError('Multipart body without parts')
+
+    while not finished:
+        # Rest of the delimiter line, which tells whether it is the close delimiter
+        while len(buf) < 2 or (not buf.startswith('--') and buf.find('\n') < 0):
+            buf, more = fill(buf)
+            if not more:
+                raise ContentTypeError('Truncated multipart body')
+        if buf.startswith('--'):
+            break
+        buf = buf[buf.find('\n') + 1:]
+
+        # Part headers, up to the first empty line
+        while True:
+            if buf.startswith('\r\n') or buf.startswith('\n'):
+                header_end = 0
+            else:
+                ends = [index for index in (buf.find('\n\n'), buf.find('\n\r\n')) if index >= 0]
+                header_end = min(ends) + 1 if ends else -1
+            if header_end >= 0:
+                break
+            buf, more = fill(buf)
+            if not more:
+                raise ContentTypeError('Truncated multipart body')
+        headers = email.message_from_string(buf[:header_end])
+        buf = buf[header_end:]
+        buf = buf[2:] if buf.startswith('\r\n') else buf[1:]
+
+        # Part payload, up to the next delimiter
+        decoder = _Decoder(headers['Content-Transfer-Encoding'], _Spool(spool_threshold))
+        while True:
+            index = buf.find(delimiter)
+            if index >= 0:
+                payload = buf[:index]
+                decoder.write(payload[:-1] if payload.endswith('\r') else payload)
+                buf = buf[index + len(delimiter):]
+                break
+            # Keep the tail, which might contain the beginning of the delimiter
+            if len(buf) > len(delimiter):
+                decoder.write(buf[:-len(delimiter)])
+                buf = buf[-len(delimiter):]
+            buf, more = fill(buf)
+            if not more:
+                raise ContentTypeError('Truncated multipart body')
+
+        yield headers.get_content_type(), decoder.close()
+
+    # Drain the epilogue, so the underlying connection can be reused
+    for chunk in chunks:
+        pass
+
+
+def iter_mms_body(content_type, body, content_length=None, spool_threshold=None):
+
+    """Parse a MMS body passed as a multipart/mixed body incrementally.
+
+    It yields the metadata first (as soon as it has been read) and then the attachments, as (content type,
+    payload) tuples. See :func:`iter_multipart` for the meaning of the parameters.
+
+    """
 
-    parts = body.get_payload()
+    parts = iter_multipart(content_type, body, content_length, spool_threshold)
 
     # First part MUST convey MMS metadata (root fields)
-    metadata = parts[0]
-    content_type = metadata.get_content_type().lower()
-    metadata = metadata.get_payload(decode=True)
+    for content_type, metadata in parts:
+        break
+    else:
+        raise ContentTypeError('Multipart body without parts')
+
     if content_type == 'application/json':
         try:
-            metadata = json.loads(metadata)
+            metadata = jsoncodec.loads(metadata)
         except ValueError:
             raise ValueError('Bad JSON content in MMS metadata')
     elif content_type == 'application/xml':
@@ -124,36 +668,169 @@ def parse_mms_body(content_type, body):
     else:
         raise ContentTypeError("Unsupported Content-Type '{0}' in MMS metadata "
                                "(only application/json and application/xml are supported".format(content_type))
+    yield metadata
 
     # Go through the rest of parts, which are the MMS attachments
-    attachments = [(part.get_content_type(),
-                    part.get_payload(decode=True)) for part in parts[1:]]
+    for part in parts:
+        yield part
+
+
+def parse_mms_body(content_type, body, content_length=None, spool_threshold=None):
+
+    """Parse a MMS body passed as a multipart/mixed body and returns metadata and attachments.  """
+
+    parts = iter_mms_body(content_type, body, content_length, spool_threshold)
+    metadata = next(parts)
+    attachments = list(parts)
 
     return metadata, attachments
 
 
+# XML entities understood by xml_to_dict(), besides character references
+_XML_ENTITIES = {u'lt': u'<', u'gt': u'>', u'amp': u'&', u'quot': u'"', u'apos': u"'"}
+_XML_ENTITY_RE = re.compile(ur'&(#[0-9]+|#x[0-9a-fA-F]+|lt|gt|amp|quot|apos);')
+_XML_CDATA_RE = re.compile(ur'<!\[CDATA\[(.*?)\]\]>', re.DOTALL)
+
+# Compiled xml_to_dict() patterns, by the tuple of keys they look for
+_xml_patterns = {}
+
+
+def _xml_pattern(keys):
+
+    """Return the (cached) regular expression matching any of the elements named after the keys.
+
+    Elements are matched by their local name, whatever their namespace prefix (e.g. ``<ns2:from>`` for
+    the ``from`` key), and can be empty (``<subject/>``).
+
+    """
+
+    try:
+        return _xml_patterns[keys]
+    except KeyError:
+        names = u'|'.join(re.escape(key if isinstance(key, unicode) else unicode(key, 'utf-8')) for key in keys)
+        # Content is text, possibly with CDATA sections, so it's matched without backtracking
+        pattern = re.compile(ur'<(?:[\w.-]+:)?(' + names + ur')(?:\s[^>]*?)?'
+                             ur'(?:/>|>([^<]*(?:<!\[CDATA\[.*?\]\]>[^<]*)*)</(?:[\w.-]+:)?\1\s*>)',
+                             re.DOTALL | re.UNICODE)
+        _xml_patterns[keys] = pattern
+        return pattern
+
+
+def _xml_unescape_entity(match):
+    entity = match.group(1)
+    if entity[0] != u'#':
+        return _XML_ENTITIES[entity]
+    return unichr(int(entity[2:], 16) if entity[1] == u'x' else int(entity[1:]))
+
+
+def _xml_text(content):
+
+    """Return the text of an element content, replacing entities and unwrapping CDATA sections. """
+
+    if u'<' not in content:
+        return _XML_ENTITY_RE.sub(_xml_unescape_entity, content) if u'&' in content else content
+    # Text in CDATA sections is literal
+    chunks = _XML_CDATA_RE.split(content)
+    for i in range(0, len(chunks), 2):
+        chunks[i] = _XML_ENTITY_RE.sub(_xml_unescape_entity, chunks[i])
+    return u''.join(chunks)
+
+
 def xml_to_dict(xml, keys):
 
     """Parse an XML document and returns a dictionary containing the specified keys.
 
     This is not a generic XML to dict parser, but a simpel implementation that search a set of specific
-    XML tags that become dictionary keys.
+    XML tags that become dictionary keys. The document is scanned once, looking for all the keys at the
+    same time, and the first element named after each key (ignoring its namespace prefix) is taken.
 
     """
 
-    try:
-        if not isinstance(xml, unicode):
-            xml = unicode(xml, 'utf-8')
+    if not isinstance(xml, unicode):
+        xml = unicode(xml, 'utf-8')
+    keys = tuple(keys)
+
+    dict_ = {}
+    for match in _xml_pattern(keys).finditer(xml):
+        key, content = match.groups()
+        if key not in dict_:
+            dict_[key] = _xml_text(content) if content else u''
+            if len(dict_) == len(keys):
+                return dict_
+
+    for key in keys:
+        if key not in dict_:
+            raise KeyError('XML does not contain the key: ' + key)
+    return dict_
+
+
+# Format of BlueVia timestamps, as understood by datetime.strptime()
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f+0000'
+_TIMESTAMP_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)\.(\d{1,6})\+0000$')
+
+
+def parse_timestamp(value):
+
+    """Convert a BlueVia timestamp into a datetime object.
+
+    It's equivalent to ``datetime.strptime(value, TIMESTAMP_FORMAT)``, but much faster for the usual
+    fixed-width timestamps (other values are passed to strptime).
+
+    """
+
+    match = _TIMESTAMP_RE.match(value)
+    if not match:
+        return datetime.strptime(value, TIMESTAMP_FORMAT)
+    fields = map(int, match.groups())
+    # The fraction of second has up to 6 digits, so it must be scaled to microseconds
+    return datetime(fields[0], fields[1], fields[2], fields[3], fields[4], fields[5],
+                    fields[6] * 10 ** (6 - len(match.group(7))))
+
+
+def sanitize_incoming_message(message):
+
+    """Sanitize an incoming SMS or the metadata of an incoming MMS in a single pass.
+
+    It is equivalent to :func:`sanitize`, but only looks at the keys of this kind of messages. Anything but
+    a dictionary is passed to :func:`sanitize` (which returns it unchanged unless it's a list).
+
+    """
+
+    if not isinstance(message, dict):
+        return sanitize(message)
+
+    value = message.get('from')
+    if value is not None:
+        obfuscated = value.startswith('alias:')
+        message['from'] = value[6:] if obfuscated else value[5:]
+        message[u'obfuscated'] = obfuscated
+    value = message.get('to')
+    if value is not None:
+        message['to'] = value[6:] if value.startswith('alias:') else value[5:]
+    value = message.get('timestamp')
+    if value is not None:
+        message['timestamp'] = parse_timestamp(value)
+
+    return message
+
+
+def sanitize_delivery_status(delivery_status):
+
+    """Sanitize a delivery status in a single pass.
+
+    It is equivalent to :func:`sanitize`, but only looks at the keys of delivery statuses. Anything but
+    a dictionary is passed to :func:`sanitize` (which returns it unchanged unless it's a list).
+
+    """
+
+    if not isinstance(delivery_status, dict):
+        return sanitize(delivery_status)
 
-        dict_ = {}
-        for key in keys:
-            if not isinstance(key, unicode):
-                key = unicode(key, 'utf-8')
-            dict_[key] = re.search('<.*' + key + '>(.*)</.*' + key + '>', xml).group(1)
+    value = delivery_status.get('address')
+    if value is not None:
+        delivery_status['address'] = value[6:] if value.startswith('alias:') else value[5:]
 
-        return dict_
-    except AttributeError:
-        raise KeyError('XML does not contain the key: ' + key)
+    return delivery_status
 
 
 def sanitize(output):
@@ -174,7 +851,7 @@ def sanitize(output):
                 if k == 'from':
                     output[u'obfuscated'] = obfuscated
             elif k == 'timestamp':
-                output[k] = datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%f+0000')
+                output[k] = parse_timestamp(v)
 
         return output
     elif isinstance(output, list):
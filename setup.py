@@ -17,6 +17,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=['requests>=1.0.0'],
+    extras_require={'ujson': ['ujson>=1.34']},
     license=open('LICENSE').read(),
     zip_safe=False,
     classifiers=(